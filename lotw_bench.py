@@ -0,0 +1,1323 @@
+#! /usr/bin/env python3
+
+#############################  N8UR lotw_bench.py  #############################
+#
+#       Copyright 2019 by John Ackermann, N8UR jra@febo.com
+#       https://febo.com -- https://github.com/n8ur
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+###############################################################################
+
+# Timing benchmarks for lotw_tool.py, run against synthetic LoTW-style
+# ADI data so no LoTW account is needed.
+
+import argparse
+import contextlib
+import hashlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+import tracemalloc
+from operator import attrgetter, itemgetter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import lotw_tool
+
+###############################################################################
+# synthetic data
+###############################################################################
+bands = ['160M','80M','40M','20M','15M','10M','6M','2M','1.25M','70CM']
+modes = ['CW','SSB','FT8','FM','RTTY']
+countries = ['UNITED STATES OF AMERICA','CANADA','MEXICO','JAPAN',
+             'ENGLAND','GERMANY','BRAZIL']
+states = ['OH','CT','TX','CA','NY','FL','MI','PA']
+
+# what make_qso generates.  LoTW only sends the other station's grid for
+# confirmed QSOs, so grid_missing is the share of confirmed QSOs without
+# one.  The band and mode weights are relative, with None for an even
+# mix.  rover is the share of QSOs with a rover (CALL/R).  The defaults
+# give the same QSOs the benchmarks have always used.
+qso_mix = {'seed': 1, 'qsl': 0.4, 'grid_missing': 0.2,
+           'band_weights': None, 'mode_weights': None, 'rover': 0.0}
+
+def pick(rnd, values, weights=None):
+    if weights:
+        return rnd.choices(values, weights)[0]
+    return rnd.choice(values)
+
+def adif_field(name, value, comment=None):
+    s = "<{}:{}>{}".format(name, len(value), value)
+    if comment:
+        s += " // " + comment
+    return s + "\n"
+
+def make_grid(rnd):
+    return (chr(65 + rnd.randrange(18)) + chr(65 + rnd.randrange(18)) +
+            str(rnd.randrange(10)) + str(rnd.randrange(10)))
+
+def make_call(rnd):
+    return (rnd.choice('KWN') + rnd.choice('ABCDEFG') + str(rnd.randrange(10))
+            + ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+                      for i in range(rnd.randrange(1, 4))))
+
+# make_qso -- one random QSO as a dict.  rx is when LoTW received it and
+# qslrx when the QSL arrived (None if there's no QSL yet).
+def make_qso(rnd):
+    year = rnd.randrange(2003, 2025)
+    month = rnd.randrange(1, 13)
+    day = rnd.randrange(1, 29)
+    q = {'call': make_call(rnd),
+         'band': pick(rnd, bands, qso_mix['band_weights']),
+         'mode': pick(rnd, modes, qso_mix['mode_weights']),
+         'date': "{:04d}{:02d}{:02d}".format(year, month, day),
+         'time': "{:02d}{:02d}{:02d}".format(rnd.randrange(24),
+             rnd.randrange(60), rnd.randrange(60)),
+         'rx': "{:04d}-{:02d}-{:02d} {:02d}:00:00".format(year, month,
+             day, rnd.randrange(24)),
+         'qslrx': None}
+    if rnd.random() < qso_mix['qsl']:
+        add_qsl(rnd, q)
+    if qso_mix['rover'] and rnd.random() < qso_mix['rover']:
+        q['call'] += '/R'
+    return q
+
+def add_qsl(rnd, q, qslrx=None):
+    q['qslrx'] = qslrx or q['rx']
+    q['country'] = rnd.choice(countries)
+    q['grid'] = make_grid(rnd) if rnd.random() < 1 - qso_mix['grid_missing'] \
+        else None
+    q['state'] = rnd.choice(states)
+
+def record_text(q):
+    s = adif_field('APP_LoTW_OWNCALL', 'N8UR')
+    s += adif_field('STATION_CALLSIGN', 'N8UR')
+    s += adif_field('MY_DXCC', '291')
+    s += adif_field('MY_COUNTRY', 'UNITED STATES OF AMERICA')
+    s += adif_field('APP_LoTW_MY_DXCC_ENTITY_STATUS', 'Current')
+    s += adif_field('MY_GRIDSQUARE', 'EM79VS')
+    s += adif_field('MY_STATE', 'OH', 'Ohio')
+    s += adif_field('CALL', q['call'])
+    s += adif_field('BAND', q['band'])
+    s += adif_field('FREQ', '50.31300')
+    s += adif_field('MODE', q['mode'])
+    s += adif_field('APP_LoTW_MODEGROUP', 'DATA')
+    s += adif_field('QSO_DATE', q['date'], 'QSO Date')
+    s += adif_field('TIME_ON', q['time'], 'QSO Start Time')
+    s += adif_field('QSL_RCVD', 'Y' if q['qslrx'] else 'N', 'QSL Received')
+    if q['qslrx']:
+        s += adif_field('QSLRDATE', q['qslrx'][:10].replace('-', ''),
+            'QSL Received Date')
+        s += adif_field('COUNTRY', q['country'])
+        if q['grid']:
+            s += adif_field('GRIDSQUARE', q['grid'])
+        s += adif_field('STATE', q['state'])
+        s += adif_field('CQZ', '05')
+        s += adif_field('ITUZ', '08')
+    return s + "<eor>\n\n"
+
+def make_record(rnd):
+    return record_text(make_qso(rnd))
+
+def make_header(num_qsos, tags={'APP_LoTW_LASTQSORX': '2024-10-23 12:00:00'}):
+    s = "ARRL Logbook of the World Status Report\n"
+    s += "Generated by lotw_bench.py\n\n"
+    s += adif_field('PROGRAMID', 'LoTW')
+    for k, v in tags.items():
+        s += adif_field(k, v)
+    s += adif_field('APP_LoTW_NUMREC', str(num_qsos))
+    return s + "\n<eoh>\n\n"
+
+def make_adi(num_qsos, seed=None):
+    rnd = random.Random(qso_mix['seed'] if seed is None else seed)
+    return make_header(num_qsos) + \
+            ''.join(make_record(rnd) for i in range(num_qsos)) + \
+            "<APP_LoTW_EOF>\n"
+
+# write_adi -- same as make_adi, but a record at a time straight to a file
+# so that huge test files don't have to fit in memory
+def write_adi(filename, num_qsos, seed=None):
+    rnd = random.Random(qso_mix['seed'] if seed is None else seed)
+    with open(filename,'w',encoding='latin1') as f:
+        f.write(make_header(num_qsos))
+        for i in range(num_qsos):
+            f.write(make_record(rnd))
+        f.write("<APP_LoTW_EOF>\n")
+
+###############################################################################
+# legacy_extract_fields -- the original per-prefix scan, kept for comparison
+###############################################################################
+def legacy_extract_fields(record):
+    d = dict.fromkeys(lotw_tool.field_keys, None)
+    d['GRIDSQUARE'] = '----'
+    d['STATE'] = '--'
+
+    fields = record.split('<')
+    for f in fields:
+        f = str(f.strip())
+        for k in lotw_tool.field_keys:
+            if f.startswith(k):
+                   d[k] = str(f.split('>')[1])
+    return d
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+###############################################################################
+# Results.  Besides printing, each benchmark records its main numbers by
+# name in results.  --json saves them, with the QSO mix they were made
+# with, and --baseline compares them against a saved run.  Names ending
+# in _per_s are rates (higher is better); _s (seconds) and _mb (memory)
+# are better lower.
+###############################################################################
+results = {}
+
+def record(name, value):
+    results[name] = round(value, 4)
+
+def save_results(filename):
+    import json
+    import platform
+    with open(filename, 'w') as f:
+        json.dump({'created_by': 'lotw_bench.py',
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpus': os.cpu_count(),
+                   'mix': qso_mix,
+                   'results': results}, f, indent=1, sort_keys=True)
+    print("Saved", len(results), "results to", filename)
+
+# compare_results -- print each result against the baseline's and return
+# the names of those more than tolerance (a fraction) worse
+def compare_results(baseline, tolerance):
+    import json
+    with open(baseline) as f:
+        base = json.load(f)
+    if base.get('mix') != qso_mix:
+        print("NOTE: the baseline was made with a different QSO mix")
+    print("against {}: result, baseline, now, change".format(baseline))
+    worse = []
+    for name in sorted(results):
+        old = base['results'].get(name)
+        new = results[name]
+        if not old or not new:
+            continue
+        # change > 0 is worse, whichever way the result goes
+        if name.endswith('_per_s'):
+            change = old / new - 1
+        else:
+            change = new / old - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  WORSE'
+            worse.append(name)
+        elif change < -tolerance:
+            flag = '  better'
+        print("{:<44} {:10.4g} {:10.4g} {:+7.0%}{}".format(name, old, new,
+            change, flag))
+    return worse
+
+###############################################################################
+# bench_extract_fields -- tokenizer vs. prefix scan
+###############################################################################
+def bench_extract_fields(sizes):
+    print("extract_fields: QSOs, legacy seconds, tokenizer seconds, speedup")
+    for n in sizes:
+        records = make_adi(n).split("<eo")
+        old = timeit(lambda: [legacy_extract_fields(r) for r in records])
+        new = timeit(lambda: [lotw_tool.extract_fields(r) for r in records])
+        print("{:>10} {:10.3f} {:10.3f} {:8.1f}x".format(n, old, new,
+            old / new))
+        record('extract_fields/{}/tokenizer_s'.format(n), new)
+
+###############################################################################
+# bench_qso_record -- memory and sort time for the QSO slots records
+# against the 45-key dicts they replaced
+###############################################################################
+def build(func, records):
+    tracemalloc.start()
+    start = time.perf_counter()
+    qsos = [func(lotw_tool.extract_fields(r)) for r in records]
+    secs = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return qsos, secs, size / 1e6
+
+def bench_qso_record(sizes):
+    print("QSO records: QSOs, kind, build seconds, MB, sort seconds")
+    for n in sizes:
+        records = [r for r in make_adi(n).split("<eo") if '<CALL:' in r]
+        dicts, secs, mb = build(dict, records)
+        sort = timeit(lambda: sorted(dicts,
+            key=itemgetter('CALL','QSO_DATE','TIME_ON')))
+        print("{:>10} {:>6} {:10.3f} {:10.1f} {:10.3f}".format(n, 'dict',
+            secs, mb, sort))
+        del dicts
+        qsos, secs, mb = build(lotw_tool.QSO.from_fields, records)
+        sort = timeit(lambda: sorted(qsos,
+            key=attrgetter('CALL','QSO_DATE','TIME_ON')))
+        print("{:>10} {:>6} {:10.3f} {:10.1f} {:10.3f}".format(n, 'QSO',
+            secs, mb, sort))
+
+###############################################################################
+# bench_format -- writing the log lines with the original format_qso
+# (month dict built per call, one write per QSO) vs. write_qsos
+###############################################################################
+def legacy_format_qso(rec, sep):
+    def make_month(argument):
+        months = {1: "Jan", 2: "Feb", 3: "Mar", 4: "Apr", 5: "May",
+            6: "Jun", 7: "Jul", 8: "Aug", 9: "Sep", 10: "Oct", 11: "Nov",
+            12: "Dec"}
+        return months.get(argument, "Invalid month")
+
+    year = rec.QSO_DATE[:4]
+    month = make_month(int(rec.QSO_DATE[4:6]))
+    day = rec.QSO_DATE[6:8]
+    date = year + "-" + month + "-" + day
+    time = rec.TIME_ON[:2] + ":" + rec.TIME_ON[2:4] \
+        + ":" + rec.TIME_ON[4:6]
+    return "{}T{}{}{}{}{}{}{}{}{}{}{}{}{}{}{}".format(
+            date, time, sep, rec.CALL, sep, rec.BAND,
+            sep, rec.MODE, sep, rec.QSL_RCVD, sep, rec.GRIDSQUARE,
+            sep, rec.STATE[:2], sep, rec.COUNTRY)
+
+def legacy_write(f, qsos, sep):
+    for rec in qsos:
+        string = legacy_format_qso(rec, sep) + '\n'
+        f.write(string)
+
+def bench_format(sizes):
+    print("format: QSOs, legacy seconds, write_qsos seconds, speedup")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            qsos = [lotw_tool.QSO.from_fields(d) for d in
+                map(lotw_tool.extract_fields, make_adi(n).split("<eo"))
+                if d['CALL']]
+            secs = []
+            for i, write in enumerate((legacy_write, lotw_tool.write_qsos)):
+                # fresh date and time caches each round
+                lotw_tool.date_text.clear()
+                lotw_tool.time_text.clear()
+                with open(os.path.join(tmp, str(i)), 'w') as f:
+                    secs.append(timeit(write, f, qsos, '\t'))
+            print("{:>10} {:10.3f} {:10.3f} {:8.1f}x".format(n, secs[0],
+                secs[1], secs[0] / secs[1]))
+            record('format/{}/write_qsos_s'.format(n), secs[1])
+            with open(os.path.join(tmp, '0')) as a, \
+                    open(os.path.join(tmp, '1')) as b:
+                if a.read() != b.read():
+                    sys.exit('write_qsos output differs')
+
+###############################################################################
+# bench_grid_stats -- one GridStats pass over the log (every band, mode
+# and band/mode) vs. building worked/confirmed grid sets one band at a
+# time, as separate runs per band would, checking the counts agree
+###############################################################################
+def band_grid_sets(qsos, band):
+    worked = set()
+    confirmed = set()
+    for q in qsos:
+        if q.BAND == band and q.GRIDSQUARE != '----':
+            worked.add(q.GRIDSQUARE[:4])
+            if q.QSL_RCVD == 'Y':
+                confirmed.add(q.GRIDSQUARE[:4])
+    return len(worked), len(confirmed)
+
+def bench_grid_stats(sizes):
+    print("grid stats: QSOs, per-band sets seconds, GridStats seconds")
+    for n in sizes:
+        qsos = [lotw_tool.QSO.from_fields(d) for d in
+            map(lotw_tool.extract_fields, make_adi(n).split("<eo"))
+            if d['CALL']]
+        start = time.perf_counter()
+        sets = {band: band_grid_sets(qsos, band) for band in bands}
+        old = time.perf_counter() - start
+        start = time.perf_counter()
+        stats = lotw_tool.GridStats()
+        stats.add_qsos(qsos)
+        report = stats.report()
+        new = time.perf_counter() - start
+        print("{:>10} {:10.3f} {:10.3f}".format(n, old, new))
+        record('grid_stats/{}/grid_stats_s'.format(n), new)
+        for band, counts in sets.items():
+            got = report['bands'].get(band, {'worked': 0, 'confirmed': 0})
+            if (got['worked'], got['confirmed']) != counts:
+                sys.exit('grid stats for {} disagree'.format(band))
+
+###############################################################################
+# bench_locator -- "everything within 1000 km" over the whole log: the
+# locator and distance worked out for every QSO vs. GeoFilter, which
+# tests each (grid, my grid) pair once, checking they keep the same QSOs
+###############################################################################
+def linear_within(qsos, km):
+    kept = []
+    for q in qsos:
+        here = lotw_tool.grid_box(q.MY_GRIDSQUARE)
+        there = lotw_tool.grid_box(q.GRIDSQUARE)
+        if here and there and lotw_tool.distance_bearing(
+                here[0] + here[2] / 2, here[1] + here[3] / 2,
+                there[0] + there[2] / 2, there[1] + there[3] / 2)[0] <= km:
+            kept.append(q)
+    return kept
+
+def bench_locator(sizes):
+    print("locator: QSOs, per-QSO seconds, GeoFilter seconds, speedup")
+    for n in sizes:
+        qsos = [lotw_tool.QSO.from_fields(d) for d in
+            map(lotw_tool.extract_fields, make_adi(n).split("<eo"))
+            if d['CALL']]
+        lotw_tool.grid_latlon.clear()
+        lotw_tool.grid_distance.clear()
+        start = time.perf_counter()
+        old = linear_within(qsos, 1000)
+        old_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        geo = lotw_tool.GeoFilter(within=1000)
+        new = [q for q in qsos if geo.keep(q.GRIDSQUARE, q.MY_GRIDSQUARE)]
+        new_secs = time.perf_counter() - start
+        print("{:>10} {:10.3f} {:10.3f} {:8.1f}x".format(n, old_secs,
+            new_secs, old_secs / new_secs))
+        record('locator/{}/geo_filter_s'.format(n), new_secs)
+        if old != new:
+            sys.exit('GeoFilter kept different QSOs')
+
+###############################################################################
+# bench_where -- --where queries over a whole ADI file: every record
+# parsed and then tested, vs. filter_records dropping what it can on the
+# raw text first.
+###############################################################################
+where_queries = ['CALL = {call}', 'BAND = 1.25M and MODE = RTTY',
+    'STATE in (CT, RI) and QSL_RCVD = Y', 'QSO_DATE >= 20240101',
+    'MODE != FT8']
+
+def bench_where(sizes):
+    print("where: QSOs, query, QSOs selected, parse-all seconds, "
+          "quick test seconds, speedup")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            adifile = os.path.join(tmp, 'where{}.adi'.format(n))
+            write_adi(adifile, n)
+            call = next(filter(None, (lotw_tool.extract_fields(r)['CALL']
+                for r in lotw_tool.read_adifile(adifile))))
+            for i, query in enumerate(where_queries):
+                args = lotw_tool.getargs(['--adifile', adifile, '--where',
+                    query.format(call=call)])
+                test = lotw_tool.where_filter(args).test
+                start = time.perf_counter()
+                old = [d for d in map(lotw_tool.extract_fields,
+                    lotw_tool.read_adifile(adifile)) if test(d)]
+                old_secs = time.perf_counter() - start
+                start = time.perf_counter()
+                new = list(lotw_tool.filter_records(args,
+                    lotw_tool.read_adifile(adifile)))
+                new_secs = time.perf_counter() - start
+                print("{:>10} {:36} {:8} {:8.2f} {:8.2f} {:8.1f}x".format(n,
+                    query.format(call=call), len(new), old_secs, new_secs,
+                    old_secs / new_secs))
+                record('where/{}/query{}_s'.format(n, i), new_secs)
+                if old != new:
+                    sys.exit('filter_records selected different QSOs')
+
+###############################################################################
+# bench_reports -- get_gridless + get_unconfirmed_grids as the log grows,
+# against the nested call x QSO loops they used to run
+###############################################################################
+def make_report_data(n):
+    records = make_adi(n).split("<eo")
+    qso_list = [lotw_tool.QSO.from_fields(d) for d in
+        map(lotw_tool.extract_fields, records) if d['CALL']]
+    rnd = random.Random(qso_mix['seed'] + 1)
+    calls = sorted({q.CALL for q in qso_list if q.GRIDSQUARE == '----'})
+    qrz = [[rnd.choice(['----', make_grid(rnd)]), c] for c in calls]
+    confirmed = sorted({q.GRIDSQUARE[:4] for q in qso_list
+        if q.GRIDSQUARE != '----'})
+    return qso_list, qrz, confirmed
+
+def legacy_reports(qso_list, qrz, confirmed):
+    gridless = [x[1] for x in qrz if x[0] == '----']
+    gridless_qsos = [y for x in gridless for y in qso_list
+        if y.CALL == x and y.GRIDSQUARE == '----']
+    qrz = [x for x in qrz if x[0] != '----' and x[0] not in confirmed]
+    qrz = [x for x in qrz if not any(y.CALL == x[1] and
+        y.GRIDSQUARE != '----' for y in qso_list)]
+    unconfirmed = [y for x in qrz for y in qso_list if y.CALL == x[1]]
+    return gridless_qsos, unconfirmed
+
+def reports(tmp, qso_list, qrz, confirmed):
+    logfile = os.path.join(tmp, 'bench.log')
+    qrzfile = os.path.join(tmp, 'bench_qrz_matches.txt')
+    lotw_tool.get_gridless(logfile, qrzfile, qso_list, qrz, '\t')
+    lotw_tool.get_unconfirmed_grids(logfile, qrzfile, qso_list, confirmed,
+        qrz, '\t')
+
+def bench_reports(sizes, legacy_max=20000):
+    print("gridless/unconfirmed reports: QSOs, gridless calls, "\
+          "legacy seconds, indexed seconds")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            data = make_report_data(n)
+            old = '{:10}'.format('-')
+            if n <= legacy_max:
+                old = '{:10.3f}'.format(timeit(legacy_reports, *data))
+            new = timeit(quietly, reports, tmp, *data)
+            print("{:>10} {:>10} {} {:10.3f}".format(n, len(data[1]), old,
+                new))
+            record('reports/{}/gridless_unconfirmed_s'.format(n), new)
+
+###############################################################################
+# bench_import -- import cost of lotw_tool (-X importtime) and wall time
+# of a small offline --adifile run.  Fails if the networking or database
+# modules are loaded at import time again.
+###############################################################################
+lazy_modules = ['requests', 'urllib3', 'sqlite3', 'concurrent.futures']
+
+def bench_import(repeat=5):
+    cmd = [sys.executable, '-X', 'importtime', '-c',
+        'import sys, lotw_tool; print(" ".join(sys.modules))']
+    best = None
+    for i in range(repeat):
+        p = subprocess.run(cmd, capture_output=True, text=True,
+            cwd=os.path.dirname(tool), check=True)
+        # last importtime line is lotw_tool itself: self | cumulative | name
+        usecs = int(p.stderr.strip().splitlines()[-1].split('|')[1])
+        best = usecs if best is None else min(best, usecs)
+    loaded = [m for m in lazy_modules if m in p.stdout.split()]
+    print("import lotw_tool: {:.1f} ms".format(best / 1000))
+    record('import/lotw_tool_s', best / 1e6)
+    if loaded:
+        sys.exit('imported at startup: ' + ' '.join(loaded))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        adifile = os.path.join(tmp, 'small.adi')
+        write_adi(adifile, 100)
+        secs = min(run_tool('--adifile', adifile)[0] for i in range(repeat))
+        print("--adifile run, 100 QSOs: {:.1f} ms".format(secs * 1000))
+        record('import/adifile_run_100_s', secs)
+
+###############################################################################
+# bench_memory -- peak RSS of a full lotw_tool.py run as the file grows.
+# Each run is a separate process, started through run_wrapper, which
+# writes the process's own high-water mark to a file when the tool is
+# done.  (The parent's ru_maxrss for the child won't do: on Linux it
+# counts the pages the child shared with this process before exec, so
+# every run looks as big as the bench.)
+###############################################################################
+tool = str(Path(__file__).resolve().parent.joinpath('lotw_tool.py'))
+
+run_wrapper = """
+import runpy, sys
+rssfile = sys.argv.pop(1)
+del sys.argv[0]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    try:
+        with open('/proc/self/status') as f:
+            kb = [int(l.split()[1]) for l in f if l.startswith('VmHWM:')][0]
+    except OSError:
+        import resource
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(rssfile, 'w') as f:
+        f.write(str(kb))
+"""
+
+def run_tool(*argv):
+    with tempfile.TemporaryDirectory() as tmp:
+        rssfile = os.path.join(tmp, 'rss')
+        start = time.perf_counter()
+        status = subprocess.call([sys.executable, '-c', run_wrapper,
+            rssfile, tool] + list(argv), stdout=subprocess.DEVNULL)
+        secs = time.perf_counter() - start
+        if status:
+            sys.exit('lotw_tool.py failed: ' + ' '.join(argv))
+        # kilobytes (ru_maxrss is too, on Linux)
+        with open(rssfile) as f:
+            return secs, int(f.read()) / 1024
+
+def bench_memory(sizes, extra=[]):
+    print("make_logfile {}: QSOs, file MB, seconds, peak RSS MB".format(
+        ' '.join(extra)))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            adifile = os.path.join(tmp, 'bench{}.adi'.format(n))
+            write_adi(adifile, n)
+            mb = os.path.getsize(adifile) / 1e6
+            secs, rss = run_tool('--adifile', adifile, *extra)
+            print("{:>10} {:10.1f} {:10.2f} {:10.1f}".format(n, mb, secs, rss))
+            name = 'memory/{}/{}'.format(n, '_'.join(extra).strip('-') or
+                'plain')
+            record(name + '/seconds_s', secs)
+            record(name + '/peak_rss_mb', rss)
+
+###############################################################################
+# FakeQRZ -- local stand-in for the QRZ.com XML interface.  Each lookup
+# sleeps for latency seconds; every fail_every'th lookup is answered
+# with a 503 to exercise the retry path.  About one call in five has no
+# grid.
+###############################################################################
+class FakeQRZHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body, headers={}):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        q = parse_qs(urlparse(self.path).query)
+        if 'username' in q:
+            return self.reply(200, "<QRZDatabase><Session>"
+                "<Key>benchkey</Key></Session></QRZDatabase>")
+        with server.lock:
+            server.lookups += 1
+            n = server.lookups
+        time.sleep(server.latency)
+        if server.fail_every and n % server.fail_every == 0:
+            return self.reply(503, "busy", {'Retry-After': '0'})
+        call = q['callsign'][0]
+        h = hashlib.md5(call.encode()).digest()
+        if h[0] < 51:
+            return self.reply(200, "<QRZDatabase><Session>"
+                "<Error>Not found: " + call + "</Error>"
+                "</Session></QRZDatabase>")
+        grid = (chr(65 + h[1] % 18) + chr(65 + h[2] % 18) + str(h[3] % 10)
+                + str(h[4] % 10) + 'ab')
+        self.reply(200, "<QRZDatabase><Callsign><call>" + call +
+            "</call>\n<grid>" + grid + "</grid></Callsign></QRZDatabase>")
+
+class FakeQRZ:
+    def __init__(self, latency=0.05, fail_every=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeQRZHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.fail_every = fail_every
+        self.server.lookups = 0
+        self.server.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{}/xml/current/'.format(
+            self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever,
+            daemon=True).start()
+        lotw_tool.qrz_https_url = lotw_tool.qrz_http_url = self.url
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+###############################################################################
+# bench_qrz -- lookup throughput against FakeQRZ for several worker counts
+###############################################################################
+def quietly(func, *args):
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        return func(*args)
+
+def qrz_args(workers, rate=0, cache='none'):
+    return argparse.Namespace(qrz_login='bench', qrz_password='bench',
+        qrz_workers=workers, qrz_rate=rate, qrz_cache=cache,
+        qrz_cache_days=30, qrz_cache_size=100000, refresh_qrz=False)
+
+def bench_qrz(num_calls, workers_list, latency):
+    rnd = random.Random(qso_mix['seed'])
+    calls = sorted({make_call(rnd) for i in range(num_calls)})
+    print("QRZ lookups: {} calls, {:.0f} ms latency".format(len(calls),
+        latency * 1000))
+    print("   workers    seconds  lookups/s")
+    expected = None
+    with FakeQRZ(latency, fail_every=50) as qrz:
+        for w in workers_list:
+            start = time.perf_counter()
+            result = quietly(lotw_tool.lookup_qrz_grids, qrz_args(w), calls)
+            secs = time.perf_counter() - start
+            if expected is None:
+                expected = result
+            elif result != expected:
+                sys.exit('QRZ results differ with {} workers'.format(w))
+            print("{:>10} {:10.2f} {:10.1f}".format(w, secs,
+                len(calls) / secs))
+            record('qrz/{}_workers/lookups_per_s'.format(w),
+                len(calls) / secs)
+        # check the rate limiter holds lookups to the requested rate
+        rate = 20
+        start = time.perf_counter()
+        quietly(lotw_tool.lookup_qrz_grids, qrz_args(max(workers_list), rate),
+            calls[:60])
+        secs = time.perf_counter() - start
+        print("rate limit {}/s: {:.1f} lookups/s".format(rate, 60 / secs))
+
+        # a second run with the cache should need no lookups at all
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = os.path.join(tmp, 'qrz_cache.sqlite')
+            for run in ('cold', 'warm'):
+                args = qrz_args(max(workers_list), cache=cache)
+                before = qrz.server.lookups
+                start = time.perf_counter()
+                result = quietly(lotw_tool.lookup_qrz_grids, args, calls)
+                secs = time.perf_counter() - start
+                if result != expected:
+                    sys.exit('QRZ results differ with {} cache'.format(run))
+                print("{} cache: {:.2f} seconds, {} lookups".format(run, secs,
+                    qrz.server.lookups - before))
+
+###############################################################################
+# FakeLoTW -- local stand-in for lotwreport.adi serving a list of
+# make_qso() dicts.  It honors qso_qsl, qso_qsorxsince, qso_qslsince,
+# qso_startdate and qso_enddate, and sets APP_LoTW_LASTQSORX or
+# APP_LoTW_LASTQSL in the header the way LoTW does.
+###############################################################################
+class FakeLoTWHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        q = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        with server.lock:
+            server.queries.append(q)
+        time.sleep(server.latency)
+        if q.get('login') != 'bench' or q.get('password') != 'bench':
+            body = "<html><body>Username/password incorrect</body></html>"
+        else:
+            body = self.report(q)
+        body = body.encode('latin1')
+        start = 0
+        rng = self.headers.get('Range', '')
+        if server.ranges and rng.startswith('bytes='):
+            start = int(rng[6:].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/x-arrl-adif')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        body = body[start:]
+        # each injected fault fires once: ('cut', n) drops the connection
+        # after n bytes, ('stall', n, seconds) goes quiet after n bytes
+        with server.lock:
+            fault = server.faults.pop(0) if server.faults else None
+        try:
+            if fault:
+                self.wfile.write(body[:fault[1]])
+                self.wfile.flush()
+                with server.lock:
+                    server.bytes_sent += fault[1]
+                if fault[0] == 'cut':
+                    self.close_connection = True
+                    return
+                time.sleep(fault[2])
+                body = body[fault[1]:]
+            # with a bandwidth limit, dribble the body out in pieces,
+            # pacing against the clock so time spent waiting for the
+            # GIL doesn't slow the link down
+            step = len(body) or 1
+            if server.bandwidth:
+                step = 64 * 1024
+            began = time.perf_counter()
+            for i in range(0, len(body), step):
+                self.wfile.write(body[i:i+step])
+                if server.bandwidth:
+                    time.sleep(max(0, began + (i + step) / server.bandwidth -
+                        time.perf_counter()))
+        except OSError:
+            return
+        with server.lock:
+            server.bytes_sent += len(body)
+
+    def report(self, q):
+        qsos = self.server.qsos
+        start = q.get('qso_startdate', '').replace('-', '')
+        end = q.get('qso_enddate', '').replace('-', '')
+        qsos = [x for x in qsos if x['date'] >= start and
+                (not end or x['date'] <= end)]
+        if q.get('qso_qsl') == 'yes':
+            since = q.get('qso_qslsince', '')
+            qsos = [x for x in qsos if x['qslrx'] and x['qslrx'] >= since]
+            tags = {'APP_LoTW_LASTQSL': max(x['qslrx'] for x in qsos)}
+        else:
+            since = q.get('qso_qsorxsince', '')
+            qsos = [x for x in qsos if x['rx'] >= since]
+            tags = {'APP_LoTW_LASTQSORX': max(x['rx'] for x in qsos)}
+        if not qsos:
+            tags = {}
+        # real LoTW takes longer to build a bigger report
+        time.sleep(len(qsos) * self.server.qso_time)
+        return make_header(len(qsos), tags) + \
+                ''.join(x.get('text') or record_text(x) for x in qsos) + "<APP_LoTW_EOF>\n"
+
+class FakeLoTW:
+    def __init__(self, qsos, latency=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLoTWHandler)
+        self.server.daemon_threads = True
+        self.server.qsos = qsos
+        self.server.latency = latency
+        self.server.queries = []
+        self.server.bytes_sent = 0
+        self.server.lock = threading.Lock()
+        self.server.ranges = False
+        self.server.qso_time = 0
+        self.server.bandwidth = 0
+        self.server.faults = []
+        self.url = 'http://127.0.0.1:{}/lotwuser/lotwreport.adi'.format(
+            self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever,
+            daemon=True).start()
+        lotw_tool.lotw_url = self.url
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def lotw_args(**kw):
+    args = argparse.Namespace(login='bench', password='bench',
+        logcall='N8UR', startdate=None, enddate=None, call=None, band=None,
+        mode=None, qsl='no', timeout=600, retries=5, chunk_size=256,
+        shards=1, shard_workers=4, stream=False, keep_adi=False, batch=None)
+    vars(args).update(kw)
+    return args
+
+# master_contents -- {identity: QSL_RCVD} for every QSO in an ADI file
+def master_contents(adifile):
+    result = {}
+    for record in lotw_tool.read_adifile(adifile):
+        d = lotw_tool.extract_fields(record)
+        if d['CALL']:
+            result[lotw_tool.qso_identity(d)] = d['QSL_RCVD']
+    return result
+
+###############################################################################
+# bench_sync -- full download vs. incremental sync after 1% new QSOs and
+# 1% new QSLs, checking the synced master matches a full download
+###############################################################################
+def bench_sync(num_qsos, latency):
+    rnd = random.Random(qso_mix['seed'])
+    qsos = [make_qso(rnd) for i in range(num_qsos)]
+    print("sync: {} QSOs; kind, seconds, KB downloaded".format(num_qsos))
+    with FakeLoTW(qsos, latency) as lotw, \
+            tempfile.TemporaryDirectory() as tmp:
+        master = os.path.join(tmp, 'master.adi')
+        for kind in ('full', 'incremental'):
+            before = lotw.server.bytes_sent
+            start = time.perf_counter()
+            quietly(lotw_tool.sync_adifile, lotw_args(), master)
+            secs = time.perf_counter() - start
+            print("{:>12} {:10.2f} {:10.0f}".format(kind, secs,
+                (lotw.server.bytes_sent - before) / 1000))
+            record('sync/{}_s'.format(kind), secs)
+            if kind == 'incremental':
+                break
+            # now some new QSOs and QSLs show up at LoTW
+            for i in range(max(1, num_qsos // 100)):
+                q = make_qso(rnd)
+                q['rx'] = '2025-01-01 00:00:00'
+                q['qslrx'] = None
+                qsos.append(q)
+                q = rnd.choice([x for x in qsos[:num_qsos] if not x['qslrx']])
+                add_qsl(rnd, q, '2025-01-02 00:00:00')
+        full = os.path.join(tmp, 'full.adi')
+        lotw_tool.download_adi(lotw_args(), lotw_tool.lotw_query(lotw_args()),
+            full)
+        if master_contents(master) != master_contents(full):
+            sys.exit('synced master log differs from full download')
+
+###############################################################################
+# bench_batch -- num_accounts club members, each a config file section,
+# run with --batch one at a time and then batch_workers at a time,
+# against a fake LoTW that takes latency seconds to answer and FakeQRZ.
+# The members' logs share most of their calls, so the shared QRZ.com
+# lookups should stay near one account's worth.  Checks every account
+# gets the same log both ways.
+###############################################################################
+def bench_batch(num_accounts, num_qsos, latency, batch_workers):
+    rnd = random.Random(qso_mix['seed'] + 4)
+    qsos = [make_qso(rnd) for i in range(num_qsos)]
+    for q in qsos:
+        q['text'] = record_text(q)
+    print("batch: {} accounts of {} QSOs, {:.1f} s LoTW latency; "
+          "accounts at once, seconds, QRZ lookups".format(num_accounts,
+          num_qsos, latency))
+    cwd = os.getcwd()
+    with FakeLoTW(qsos, latency) as lotw, FakeQRZ(0.005) as qrz, \
+            tempfile.TemporaryDirectory() as tmp:
+        config = os.path.join(tmp, 'club.cfg')
+        with open(config, 'w') as f:
+            for i in range(num_accounts):
+                f.write("[member{0}]\nlogin: bench\npassword: bench\n"
+                    "logcall: M{0}\n\n".format(i))
+        logs = {}
+        try:
+            for workers in (1, batch_workers):
+                os.chdir(tmp)
+                for name in os.listdir(tmp):
+                    if name != 'club.cfg':
+                        os.unlink(name)
+                before = qrz.server.lookups
+                start = time.perf_counter()
+                result = quietly(lotw_tool.main, ['--config', config,
+                    '--batch', 'ALL', '--batch_workers', str(workers),
+                    '--match_missing_grids', '--qrz_login', 'bench',
+                    '--qrz_password', 'bench', '--qrz_rate', '0',
+                    '--qrz_cache', 'none'])
+                secs = time.perf_counter() - start
+                print("{:>12} {:10.2f} {:10d}".format(workers, secs,
+                    qrz.server.lookups - before))
+                record('batch/{}_at_once_s'.format(workers), secs)
+                for section, summary in result.items():
+                    if 'error' in summary:
+                        sys.exit('{} failed: {}'.format(section,
+                            summary['error']))
+                    with open(summary['logfile']) as f:
+                        log = [l for l in f if not l.startswith('#')]
+                    if logs.setdefault(section, log) != log:
+                        sys.exit('{} log differs run in batch'.format(
+                            section))
+        finally:
+            os.chdir(cwd)
+
+###############################################################################
+# bench_serve -- what a dashboard polling /log sees: a run of lotw_tool.py
+# per question vs. asking a --serve server, first (the server filters,
+# sorts and formats) and again (the answer is kept), and the first ask
+# after 1% more QSOs are appended to the file.  Checks the server's log
+# is the one lotw_tool.py writes.
+###############################################################################
+def serve_get(url):
+    from urllib.request import urlopen
+    start = time.perf_counter()
+    with urlopen(url) as r:
+        body = r.read().decode()
+    return time.perf_counter() - start, body
+
+# serve_quietly -- lotw_tool.serve without its messages or request log
+def serve_quietly(args, ready):
+    with contextlib.redirect_stderr(open(os.devnull, 'w')):
+        quietly(lotw_tool.serve, args, ready)
+
+def bench_serve(sizes, repeat=20):
+    print("serve: QSOs; seconds for a lotw_tool.py run, server load, "
+          "first ask, ms to ask again, seconds after an append")
+    query = '/log?sortby=CALL&noqsl'
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            adifile = os.path.join(tmp, 'serve{}.adi'.format(n))
+            logfile = os.path.join(tmp, 'serve{}.log'.format(n))
+            write_adi(adifile, n)
+            run_secs = run_tool('--adifile', adifile, '--logfile', logfile,
+                '--sortby', 'CALL', '--noqsl')[0]
+            args = lotw_tool.getargs(['--adifile', adifile, '--serve', '0'])
+            ready = threading.Event()
+            servers = []
+            def listening(httpd):
+                servers.append(httpd)
+                ready.set()
+            start = time.perf_counter()
+            thread = threading.Thread(target=serve_quietly,
+                args=(args, listening))
+            thread.start()
+            ready.wait()
+            load_secs = time.perf_counter() - start
+            url = 'http://127.0.0.1:{}'.format(servers[0].server_address[1])
+            first_secs, body = serve_get(url + query)
+            again_secs = min(serve_get(url + query)[0]
+                for i in range(repeat))
+            with open(logfile) as f:
+                if [l for l in f if l[0] != '#'] != \
+                        [l for l in body.splitlines(True) if l[0] != '#']:
+                    sys.exit('served log differs from the log file')
+            rnd = random.Random(qso_mix['seed'] + 5)
+            with open(adifile,'a',encoding='latin1') as f:
+                for i in range(max(1, n // 100)):
+                    f.write(make_record(rnd))
+            append_secs = serve_get(url + query)[0]
+            servers[0].shutdown()
+            thread.join()
+            print("{:>10} {:8.2f} {:8.2f} {:8.3f} {:8.2f} {:8.3f}".format(n,
+                run_secs, load_secs, first_secs, again_secs * 1000,
+                append_secs))
+            record('serve/{}/ask_again_s'.format(n), again_secs)
+            record('serve/{}/after_append_s'.format(n), append_secs)
+
+###############################################################################
+# bench_download -- a clean download, then downloads that get cut off or
+# stall partway through, with and without Range support, checking each
+# finished file matches the clean one.  Time includes the retry backoff.
+###############################################################################
+def bench_download(num_qsos):
+    rnd = random.Random(qso_mix['seed'] + 1)
+    qsos = [make_qso(rnd) for i in range(num_qsos)]
+    print("download: {} QSOs; case, seconds, KB sent, tries".format(num_qsos))
+    with FakeLoTW(qsos) as lotw, tempfile.TemporaryDirectory() as tmp:
+        clean = None
+        cases = [('clean', False, []),
+                 ('cut', False, [('cut', 1000000)]),
+                 ('cut+range', True, [('cut', 1000000)]),
+                 ('stall', False, [('stall', 1000000, 5)]),
+                 ('stall+range', True, [('stall', 1000000, 5)])]
+        for name, ranges, faults in cases:
+            lotw.server.ranges = ranges
+            lotw.server.faults = list(faults)
+            before = lotw.server.bytes_sent
+            tries = len(lotw.server.queries)
+            adifile = os.path.join(tmp, name + '.adi')
+            args = lotw_args(timeout=1)
+            start = time.perf_counter()
+            quietly(lotw_tool.download_adi, args,
+                lotw_tool.lotw_query(args), adifile)
+            secs = time.perf_counter() - start
+            print("{:>12} {:10.2f} {:10.0f} {:6d}".format(name, secs,
+                (lotw.server.bytes_sent - before) / 1000,
+                len(lotw.server.queries) - tries))
+            record('download/{}_s'.format(name.replace('+', '_')), secs)
+            with open(adifile, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            if clean is None:
+                clean = digest
+            elif digest != clean:
+                sys.exit('{} download differs from the clean one'.format(name))
+
+###############################################################################
+# bench_shards -- one big LoTW query vs. the same query split into date
+# shards, against a fake server that takes qso_time seconds per QSO to
+# build a report.  Checks every sharding gives the same QSOs.
+###############################################################################
+def bench_shards(num_qsos, shard_counts, qso_time):
+    rnd = random.Random(qso_mix['seed'] + 2)
+    qsos = [make_qso(rnd) for i in range(num_qsos)]
+    # build the record text up front so the fake server's own CPU time
+    # doesn't crowd out the client threads
+    for q in qsos:
+        q['text'] = record_text(q)
+    print("shards: {} QSOs, {:.0f} us/QSO at the server; shards, workers, "
+          "seconds".format(num_qsos, qso_time * 1e6))
+    with FakeLoTW(qsos) as lotw, tempfile.TemporaryDirectory() as tmp:
+        lotw.server.qso_time = qso_time
+        expected = None
+        for shards in shard_counts:
+            adifile = os.path.join(tmp, 'shards{}.adi'.format(shards))
+            args = lotw_args(shards=shards, shard_workers=shards)
+            start = time.perf_counter()
+            quietly(lotw_tool.get_adifile, args, adifile)
+            secs = time.perf_counter() - start
+            print("{:>12} {:8d} {:10.2f}".format(shards, shards, secs))
+            record('shards/{}_s'.format(shards), secs)
+            got = master_contents(adifile)
+            if expected is None:
+                expected = got
+            elif got != expected:
+                sys.exit('{} shards gave different QSOs'.format(shards))
+        if len(expected) != len(set(qso_identity_of(q) for q in qsos)):
+            sys.exit('sharded download lost QSOs')
+
+def qso_identity_of(q):
+    return (q['call'], q['date'], q['time'], q['band'].upper(),
+        q['mode'].upper())
+
+###############################################################################
+# bench_stream -- download then process vs. processing the LoTW body as
+# it arrives, over a fake link of the given bandwidth (bytes/second).
+# Checks both ways write the same log file.
+###############################################################################
+def bench_stream(num_qsos, bandwidth):
+    rnd = random.Random(qso_mix['seed'] + 3)
+    qsos = [make_qso(rnd) for i in range(num_qsos)]
+    for q in qsos:
+        q['text'] = record_text(q)
+    print("stream: {} QSOs at {:.0f} KB/s; mode, seconds".format(num_qsos,
+        bandwidth / 1000))
+    with FakeLoTW(qsos) as lotw, tempfile.TemporaryDirectory() as tmp:
+        lotw.server.bandwidth = bandwidth
+        logs = []
+        for stream in (False, True):
+            args = lotw_tool.getargs(['--login', 'bench', '--password',
+                'bench', '--logcall', 'N8UR', '--sortby', 'CALL'] +
+                (['--stream'] if stream else []))
+            adifile = os.path.join(tmp, 'stream{}.adi'.format(stream))
+            logfile = os.path.join(tmp, 'stream{}.log'.format(stream))
+            start = time.perf_counter()
+            if stream:
+                quietly(lambda: lotw_tool.process_log(args, adifile,
+                    logfile, lotw_tool.stream_adifile(args, adifile)))
+            else:
+                quietly(lotw_tool.get_adifile, args, adifile)
+                quietly(lotw_tool.process_log, args, adifile, logfile)
+            secs = time.perf_counter() - start
+            print("{:>12} {:10.2f}".format('stream' if stream else 'download',
+                secs))
+            record('stream/{}_s'.format('stream' if stream else 'download'),
+                secs)
+            with open(logfile) as f:
+                logs.append(f.readlines()[-num_qsos:])
+        if logs[0] != logs[1]:
+            sys.exit('streamed log differs from downloaded log')
+
+###############################################################################
+# bench_workers -- make_logfile on one synthetic file with 1..N parsing
+# processes, checking each gives the same QSOs.  Speedup can't go past
+# the number of cores, which is printed too.
+###############################################################################
+def bench_workers(num_qsos, workers_list):
+    print("workers: {} QSOs, {} cores; workers, seconds, speedup".format(
+        num_qsos, os.cpu_count()))
+    with tempfile.TemporaryDirectory() as tmp:
+        adifile = os.path.join(tmp, 'workers.adi')
+        logfile = os.path.join(tmp, 'workers.log')
+        write_adi(adifile, num_qsos)
+        base = expected = None
+        for workers in workers_list:
+            args = lotw_tool.getargs(['--adifile', adifile, '--sortby',
+                'CALL', '--workers', str(workers)])
+            start = time.perf_counter()
+            qsos = quietly(lotw_tool.make_logfile, args, adifile, logfile)
+            secs = time.perf_counter() - start
+            base = base or secs
+            print("{:>12} {:10.2f} {:8.2f}x".format(workers, secs,
+                base / secs))
+            record('workers/{}_s'.format(workers), secs)
+            qsos = [repr(q) for q in qsos]
+            if expected is None:
+                expected = qsos
+            elif qsos != expected:
+                sys.exit('{} workers gave different QSOs'.format(workers))
+
+###############################################################################
+# bench_make_logfile -- make_logfile on a synthetic file, sorted by date
+# and then by each of the --sortby choices
+###############################################################################
+def bench_make_logfile(sizes):
+    fields = [None, 'CALL', 'GRIDSQUARE', 'STATE', 'COUNTRY', 'BAND', 'MODE']
+    print("make_logfile: QSOs; seconds sorted by date, " +
+        ', '.join(fields[1:]))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            adifile = os.path.join(tmp, 'make{}.adi'.format(n))
+            logfile = os.path.join(tmp, 'make{}.log'.format(n))
+            write_adi(adifile, n)
+            times = []
+            for field in fields:
+                args = lotw_tool.getargs(['--adifile', adifile] +
+                    (['--sortby', field] if field else []))
+                times.append(timeit(quietly, lotw_tool.make_logfile, args,
+                    adifile, logfile))
+                record('make_logfile/{}/{}_s'.format(n,
+                    (field or 'date').lower()), times[-1])
+            print("{:>10}".format(n) +
+                ''.join(' {:8.2f}'.format(t) for t in times))
+
+###############################################################################
+# bench_cache -- make_logfile parsing the ADI text vs. building and then
+# reusing the --cache column cache, checking all three give the same QSOs
+###############################################################################
+def bench_cache(sizes):
+    print("cache: QSOs; parse, build, cached seconds; cache MB")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            adifile = os.path.join(tmp, 'cache{}.adi'.format(n))
+            logfile = os.path.join(tmp, 'cache{}.log'.format(n))
+            write_adi(adifile, n)
+            times = []
+            results = []
+            for extra in ([], ['--cache'], ['--cache']):
+                args = lotw_tool.getargs(['--adifile', adifile, '--sortby',
+                    'BAND', '--noqsl'] + extra)
+                start = time.perf_counter()
+                qsos = quietly(lotw_tool.make_logfile, args, adifile, logfile)
+                times.append(time.perf_counter() - start)
+                results.append([repr(q) for q in qsos])
+            print("{:>10} {:8.2f} {:8.2f} {:8.2f} {:8.1f}".format(n, *times,
+                os.path.getsize(adifile + '.cache') / 1e6))
+            for kind, secs in zip(('parse', 'build', 'cached'), times):
+                record('cache/{}/{}_s'.format(n, kind), secs)
+            if results[1] != results[0] or results[2] != results[0]:
+                sys.exit('cached QSOs differ from parsed QSOs')
+
+###############################################################################
+# bench_sortby -- the log in all six --sortby orders: six separate runs
+# vs. one run with --also_sortby ALL, checking the logs match
+###############################################################################
+def bench_sortby(sizes):
+    fields = ['CALL', 'GRIDSQUARE', 'STATE', 'COUNTRY', 'BAND', 'MODE']
+    print("sortby: QSOs; 6 runs, 1 run seconds")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            adifile = os.path.join(tmp, 'sortby{}.adi'.format(n))
+            write_adi(adifile, n)
+            separate = 0
+            for field in fields:
+                logfile = os.path.join(tmp, 'one_by_{}.log'.format(
+                    field.lower()))
+                separate += run_tool('--adifile', adifile, '--grid', 'none',
+                    '--sortby', field, '--logfile', logfile)[0]
+            logfile = os.path.join(tmp, 'all.log')
+            together = run_tool('--adifile', adifile, '--grid', 'none',
+                '--also_sortby', 'ALL', '--logfile', logfile)[0]
+            print("{:>10} {:10.2f} {:10.2f}".format(n, separate, together))
+            record('sortby/{}/also_sortby_all_s'.format(n), together)
+            for field in fields:
+                name = 'by_{}.log'.format(field.lower())
+                logs = []
+                for logfile in ('one_' + name, 'all_' + name):
+                    with open(os.path.join(tmp, logfile)) as f:
+                        logs.append([l for l in f if not l.startswith('#')])
+                if logs[0] != logs[1]:
+                    sys.exit('--also_sortby {} log differs'.format(field))
+
+# weights -- parse BAND=WEIGHT arguments into a weight per entry of
+# values, in order
+def weights(specs, values):
+    given = {}
+    for spec in specs:
+        k, sep, w = spec.upper().partition('=')
+        if k not in values or not sep:
+            sys.exit('expected one of {} =weight, not {}'.format(
+                ','.join(values), spec))
+        given[k] = float(w)
+    return [given.get(v, 0) for v in values]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+            'Benchmarks for lotw_tool.py')
+    parser.add_argument('--only',type=str,nargs='+',metavar='BENCH',
+                      help='run only these benchmarks (default all)')
+    parser.add_argument('--json',type=str,metavar='FILE',
+                      help='save the results to this JSON file')
+    parser.add_argument('--baseline',type=str,metavar='FILE',
+                      help='compare the results with this saved JSON file')
+    parser.add_argument('--tolerance',type=float,default=0.25,
+                      help='fraction worse than the baseline to flag '\
+                           '(default 0.25)')
+
+    # the synthetic QSO mix
+    parser.add_argument('--seed',type=int,default=qso_mix['seed'],
+                      help='random seed for the synthetic QSOs')
+    parser.add_argument('--qsl',type=float,default=qso_mix['qsl'],
+                      help='fraction of QSOs confirmed')
+    parser.add_argument('--grid_missing',type=float,
+                      default=qso_mix['grid_missing'],
+                      help='fraction of confirmed QSOs without a grid')
+    parser.add_argument('--rover',type=float,default=qso_mix['rover'],
+                      help='fraction of QSOs with a rover')
+    parser.add_argument('--band_mix',type=str,nargs='+',metavar='BAND=W',
+                      help='relative weight of each band (others 0; '\
+                           'default even)')
+    parser.add_argument('--mode_mix',type=str,nargs='+',metavar='MODE=W',
+                      help='relative weight of each mode (others 0; '\
+                           'default even)')
+
+    parser.add_argument('--sizes',type=int,nargs='+',
+                      default=[1000,10000,100000],
+                      help='QSO counts to benchmark')
+    parser.add_argument('--memory_sizes',type=int,nargs='+',
+                      default=[10000,100000,1000000],
+                      help='QSO counts for the memory benchmark')
+    parser.add_argument('--qrz_calls',type=int,default=500,
+                      help='calls to look up in the QRZ benchmark')
+    parser.add_argument('--qrz_workers',type=int,nargs='+',
+                      default=[1,4,16],
+                      help='worker counts for the QRZ benchmark')
+    parser.add_argument('--qrz_latency',type=float,default=0.05,
+                      help='fake QRZ server latency in seconds')
+    parser.add_argument('--sync_qsos',type=int,default=50000,
+                      help='QSOs in the fake LoTW account for the sync '\
+                           'benchmark')
+    parser.add_argument('--batch_accounts',type=int,default=8,
+                      help='accounts in the batch benchmark')
+    parser.add_argument('--batch_qsos',type=int,default=5000,
+                      help='QSOs per account in the batch benchmark')
+    parser.add_argument('--download_qsos',type=int,default=20000,
+                      help='QSOs in the fake LoTW account for the download '\
+                           'benchmark')
+    parser.add_argument('--shard_qsos',type=int,default=50000,
+                      help='QSOs in the fake LoTW account for the shard '\
+                           'benchmark')
+    parser.add_argument('--shards',type=int,nargs='+',default=[1,2,4,8],
+                      help='shard counts for the shard benchmark')
+    parser.add_argument('--stream_qsos',type=int,default=50000,
+                      help='QSOs in the fake LoTW account for the stream '\
+                           'benchmark')
+    parser.add_argument('--workers_qsos',type=int,default=500000,
+                      help='QSOs in the file for the workers benchmark')
+    parser.add_argument('--workers',type=int,nargs='+',default=[1,2,4,8],
+                      help='process counts for the workers benchmark')
+    args = parser.parse_args()
+
+    qso_mix.update(seed=args.seed, qsl=args.qsl,
+        grid_missing=args.grid_missing, rover=args.rover)
+    if args.band_mix:
+        qso_mix['band_weights'] = weights(args.band_mix, bands)
+    if args.mode_mix:
+        qso_mix['mode_weights'] = weights(args.mode_mix, modes)
+
+    def memory():
+        bench_memory(args.memory_sizes)
+        # a selective filter keeps few records, so RSS should stay flat
+        bench_memory(args.memory_sizes, ['--grid', 'FN31'])
+        # an external sort should keep RSS flat with nothing filtered out
+        bench_memory(args.memory_sizes, ['--max_memory', '16'])
+
+    benches = {
+        'import': bench_import,
+        'extract_fields': lambda: bench_extract_fields(args.sizes),
+        'qso_record': lambda: bench_qso_record(args.sizes),
+        'format': lambda: bench_format(args.sizes),
+        'grid_stats': lambda: bench_grid_stats(args.sizes),
+        'locator': lambda: bench_locator(args.sizes),
+        'where': lambda: bench_where(args.sizes),
+        'make_logfile': lambda: bench_make_logfile(args.sizes),
+        'reports': lambda: bench_reports(args.sizes),
+        'cache': lambda: bench_cache(args.sizes),
+        'sortby': lambda: bench_sortby(args.sizes),
+        'qrz': lambda: bench_qrz(args.qrz_calls, args.qrz_workers,
+            args.qrz_latency),
+        'sync': lambda: bench_sync(args.sync_qsos, 0.1),
+        'serve': lambda: bench_serve(args.sizes),
+        'batch': lambda: bench_batch(args.batch_accounts, args.batch_qsos,
+            2, max(args.workers)),
+        'download': lambda: bench_download(args.download_qsos),
+        'shards': lambda: bench_shards(args.shard_qsos, args.shards, 100e-6),
+        'stream': lambda: bench_stream(args.stream_qsos, 5e6),
+        'workers': lambda: bench_workers(args.workers_qsos, args.workers),
+        'memory': memory,
+    }
+    for name in args.only or []:
+        if name not in benches:
+            parser.error('unknown benchmark {}; choose from {}'.format(name,
+                ', '.join(benches)))
+    for name, bench in benches.items():
+        if not args.only or name in args.only:
+            bench()
+
+    if args.json:
+        save_results(args.json)
+    if args.baseline and compare_results(args.baseline, args.tolerance):
+        sys.exit(1)
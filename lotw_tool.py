@@ -20,15 +20,22 @@
 version = "2019-10-18.1"
 
 import sys
+import re
 import string
+import threading
 import time
-import requests
-from requests.exceptions import HTTPError
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 from pathlib import Path
 import argparse
 import configparser
+import os
+import operator
+from operator import attrgetter, itemgetter
+from datetime import date, timedelta
+from math import radians, degrees, sin, cos, asin, atan2, sqrt
+
+# requests, sqlite3 and concurrent.futures are imported in the functions
+# that use them.  Loading requests takes longer than processing a small
+# log, and most --adifile runs never touch the network.
 
 ###############################################################################
 # Fields contained in LOTW download
@@ -38,7 +45,7 @@ field_keys = [
     'APP_LoTW_CREDIT_GRANTED','APP_LoTW_DXCC_ENTITY_STATUS',
     'APP_LoTW_GRIDSQUARE_Invalid','APP_LoTW_ITUZ_Inferred',
     'APP_LoTW_ITUZ_Invalid','APP_LoTW_LASTQSORX','APP_LoTW_MODEGROUP',
-    'APP_LoTW_MY_CQ_ZONE_Inferre','APP_LoTW_MY_DXCC_ENTITY_STATUS,',
+    'APP_LoTW_MY_CQ_ZONE_Inferred','APP_LoTW_MY_DXCC_ENTITY_STATUS',
     'APP_LoTW_MY_GRIDSQUARE_Invalid','APP_LoTW_MY_ITU_ZONE_Inferred',
     'APP_LoTW_NUMREC','APP_LoTW_OWNCALL','APP_LoTW_QSLMODE','BAND',
     'CALL','CNTY','COUNTRY','CQZ','CREDIT_GRANTED','DXCC','FREQ',
@@ -71,10 +78,27 @@ def getconfigfile(filename, section):
         config_args[key] = lotw_section[key]
     return config_args
 
+# getconfigsections -- the section names in the config file
+def getconfigsections(filename):
+    config = configparser.ConfigParser()
+    config.read(Path(filename).expanduser())
+    return config.sections()
+
 ###############################################################################
-# getargs -- get command line arguments and supply defaults
+# getargs -- get command line arguments (sys.argv unless argv is given)
+# and supply defaults.  section, if given, replaces --section; --batch
+# uses it to get each account's options.
 ###############################################################################
-def getargs():
+# the download, QRZ.com and parallelism settings -- how a run goes rather
+# than what it selects.  write_log leaves them out of the log header
+# unless they've been changed.
+tuning_defaults = {'timeout': 600, 'retries': 5, 'chunk_size': 256,
+    'shards': 1, 'shard_workers': 4, 'batch_workers': 4,
+    'qrz_workers': 8, 'qrz_rate': 10,
+    'qrz_cache': '~/.lotw_tool/qrz_cache.sqlite', 'qrz_cache_days': 30,
+    'qrz_cache_size': 100000, 'workers': 1}
+
+def getargs(argv=None, section=None):
     parser = argparse.ArgumentParser(description=
             'Tool to download/parse ARRL Log of the World ADI files')
 
@@ -96,10 +120,50 @@ def getargs():
                       default='LoTW',
                       help='config file section name')
 
+    # run several accounts at once, each from its own config file
+    # section, sharing one QRZ.com session and cache
+    parser.add_argument('--batch',type=str,nargs='+',metavar='SECTION',
+                      help='Run for each of these config file sections '\
+                           '(ALL for every section)')
+    parser.add_argument('--batch_workers',type=int,
+                      default=tuning_defaults['batch_workers'],
+                      help='Accounts to run at once with --batch (default 4)')
+
     # login and file parametersp
     parser.add_argument('--adifile',type=str,
                       help='read this ADI file (if blank, download from LoTW')
 
+    # keep a master ADI file up to date by asking LoTW only for what's
+    # changed since the last sync.  The LoTW selection options don't
+    # apply to the download, only to the logfile output.
+    parser.add_argument('--sync',type=str,metavar='MASTERFILE',
+                      help='update this master ADI file from LoTW '\
+                           'and process it')
+
+    # LoTW download tuning.  LoTW can think for several minutes before
+    # it sends anything, so the read timeout is long.
+    parser.add_argument('--timeout',type=float,
+                      default=tuning_defaults['timeout'],
+                      help='Give up on a stalled LoTW download after this '\
+                           'many seconds (default 600)')
+    parser.add_argument('--retries',type=int,
+                      default=tuning_defaults['retries'],
+                      help='Times to retry a failed LoTW download (default 5)')
+    parser.add_argument('--chunk_size',type=int,
+                      default=tuning_defaults['chunk_size'],
+                      help='LoTW download chunk size in KB (default 256)')
+    parser.add_argument('--shards',type=int,
+                      default=tuning_defaults['shards'],
+                      help='Split the LoTW download into this many date '\
+                           'ranges (default 1)')
+    parser.add_argument('--shard_workers',type=int,
+                      default=tuning_defaults['shard_workers'],
+                      help='Date ranges to download at once (default 4)')
+    parser.add_argument('--stream',action='store_true',
+                      help='Process the LoTW download as it arrives')
+    parser.add_argument('--keep_adi',action='store_true',
+                      help='With --stream, save the ADI file as well')
+
     # note: --login, --password, --logcall, --mygrid
     # are all ignored if --adifile is specified
     parser.add_argument("--login", help='LOtW user name')
@@ -126,6 +190,28 @@ def getargs():
                       help='Merge QRZ grid data to QSOs with missing grid')
     parser.add_argument("--qrz_login", help='QRZ user name')
     parser.add_argument("--qrz_password", help='QRZ user password')
+    parser.add_argument('--qrz_workers',type=int,
+                      default=tuning_defaults['qrz_workers'],
+                      help='QRZ lookups to run at once (default 8)')
+    parser.add_argument('--qrz_rate',type=float,
+                      default=tuning_defaults['qrz_rate'],
+                      help='Max QRZ lookups per second; 0 for no limit '\
+                           '(default 10)')
+
+    # QRZ results are cached between runs since call->grid rarely
+    # changes.  Use "--qrz_cache none" to turn the cache off.
+    parser.add_argument('--qrz_cache',type=str,
+                      default=tuning_defaults['qrz_cache'],
+                      help='QRZ lookup cache file; \'None\' for no cache')
+    parser.add_argument('--qrz_cache_days',type=float,
+                      default=tuning_defaults['qrz_cache_days'],
+                      help='Look calls up again after this many days '\
+                           '(default 30)')
+    parser.add_argument('--qrz_cache_size',type=int,
+                      default=tuning_defaults['qrz_cache_size'],
+                      help='Max calls kept in the QRZ cache (default 100000)')
+    parser.add_argument('--refresh_qrz',action='store_true',
+                      help='Ignore cached QRZ results and look up every call')
 
     
     parser.add_argument('--startdate',type=str,
@@ -157,19 +243,109 @@ def getargs():
     parser.add_argument('--grid',type=str.upper,
                       help='Select QSOs from this grid; \'None\' for missing')
 
+    # select by where the other station's grid is rather than by its
+    # name: within a distance of my grid (each QSO's MY_GRIDSQUARE, or
+    # --center), inside a lat/lon box, or in or next to a grid.  Grids
+    # are taken as the center of the square, and QSOs without a grid
+    # are left out.
+    parser.add_argument('--within',type=float,metavar='KM',
+                      help='Select QSOs within this many km of my grid')
+    parser.add_argument('--center',type=str.upper,metavar='GRID',
+                      help='Measure distances from this grid instead of '\
+                           'MY_GRIDSQUARE')
+    parser.add_argument('--bbox',type=float,nargs=4,
+                      metavar=('LAT1','LON1','LAT2','LON2'),
+                      help='Select QSOs between these latitudes, from '\
+                           'LON1 east to LON2')
+    parser.add_argument('--neighbors',type=str.upper,metavar='GRID',
+                      help='Select QSOs in this grid or the ones around it')
+
+    # anything else, as an expression on the ADIF fields; see
+    # "Where expressions" below
+    parser.add_argument('--where',type=str,metavar='EXPR',
+                      help='Select QSOs matching this expression, e.g. '\
+                           '"BAND in (6M,2M) and GRIDSQUARE is null"')
+
+    parser.add_argument('--distance',action='store_true',
+                      help='Add distance (km) and bearing from my grid '\
+                           'to the log')
+
     # sort parameters.  To keep things sane, you can
     # only sort by one of these (plus QSO date/time).  Input will be
     # changed to upper case.
-    choices=['CALL','GRIDSQUARE', 'STATE', 'COUNTRY', 'BAND', 'MODE']
+    choices=list(sort_choices)
     parser.add_argument('--sortby',type=str.upper,default=None,choices=choices)
+    # more log files, each sorted by one more of those fields (or ALL of
+    # them), named like the log file with _by_<field> added
+    parser.add_argument('--also_sortby',type=str.upper,nargs='+',
+                      choices=choices + ['ALL'],
+                      help='Also write the log sorted by each of these')
+
+    # JSON report of worked/confirmed grids by band and mode, with VUCC
+    # (and, given the list of its grids, FFMA) progress
+    parser.add_argument('--grid_stats',action='store_true',
+                      help='Write grid statistics by band and mode as JSON')
+    parser.add_argument('--ffma_grids',type=str,metavar='GRIDFILE',
+                      help='File listing the FFMA grids, for --grid_stats')
+
+    parser.add_argument('--workers',type=int,
+                      default=tuning_defaults['workers'],
+                      help='Parse the ADI file with this many processes '\
+                           '(default 1)')
+
+    parser.add_argument('--max_memory',type=float,
+                      help='Sort the log in runs of about this many MB, '\
+                           'spilling to temporary files')
+
+    parser.add_argument('--cache',action='store_true',
+                      help='Keep a parsed copy of the ADI file next to it '\
+                           'to speed up later runs')
+
+    # load the ADI file into an SQLite database (only when it changes)
+    # and run the reports as queries against it.  With --db, --call,
+    # --band, --mode, --startdate and --enddate filter the output too.
+    parser.add_argument('--db',type=str,
+                      help='QSO database file to load the ADI file into')
+
+    # time, memory, I/O and HTTP counts for each stage of the run, to see
+    # where a run goes and to catch it getting slower
+    parser.add_argument('--metrics_json',type=str,metavar='FILE',
+                      help='Write timings and counts for each stage as JSON')
+    parser.add_argument('--profile',type=str,choices=metric_stages,
+                      metavar='STAGE',
+                      help='Profile this stage with cProfile and tracemalloc '\
+                           '(one of: ' + ', '.join(metric_stages) + ')')
+
+    # keep adifile loaded and answer report requests over HTTP on
+    # localhost, picking up changes to the file as they come
+    parser.add_argument('--serve',type=int,metavar='PORT',
+                      help='Serve the log and reports from memory on '\
+                           'http://127.0.0.1:PORT/ (needs --adifile)')
 
     # output file parameters
     parser.add_argument('--logfile',type=str,
-                      help='Log file name (if not given, autogenerate it')
+                      help='Log file name (if not given, autogenerate it; '\
+                           '\'-\' for stdout)')
     parser.add_argument('--separator',type=str,default='\t',
                       help='Log file field separator (default is tab)')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if section:
+        args.section = section
+    elif args.batch:
+        # each section's options are read, and checked, as its own run
+        if args.adifile or args.sync or args.logfile or args.db:
+            parser.error("Error: --adifile, --sync, --logfile and --db go "\
+                "in the config file sections with --batch")
+        if args.profile or args.serve is not None:
+            parser.error("Error: --profile and --serve can't be used with "\
+                "--batch")
+        if 'ALL' in [b.upper() for b in args.batch]:
+            args.batch = getconfigsections(args.config)
+        if not args.batch:
+            parser.error("Error: no config file sections to run")
+        return args
 
     # read config file - overwrite only if no command line arg exists
     config_args = getconfigfile(args.config, args.section)
@@ -186,11 +362,42 @@ def getargs():
 #        if not args.qrz_login or not argz.qrz_password:
 #            parser.error("Error: --qso_nogrid requires QRZ login and password")
 
+    if args.adifile and args.sync:
+        parser.error("Error: use either --adifile or --sync, not both")
+    if args.serve is not None and (not args.adifile or args.db or
+            args.cache or args.also_sortby):
+        parser.error("Error: --serve needs --adifile, and can't be used "\
+            "with --db, --cache or --also_sortby")
+    if args.also_sortby and 'ALL' in args.also_sortby:
+        args.also_sortby = choices
+    if args.max_memory is not None and args.max_memory <= 0:
+        parser.error("Error: --max_memory must be more than 0 MB")
+    if args.also_sortby and args.max_memory:
+        parser.error("Error: --also_sortby can't be used with --max_memory")
+    if args.stream and (args.adifile or args.sync or args.db or
+            args.shards > 1):
+        parser.error("Error: --stream can't be used with --adifile, "\
+            "--sync, --db or --shards")
+
     if args.adifile and (args.login or args.password or args.logcall):
+        # on stderr, as with --logfile - the log itself goes to stdout
         print("NOTE: adifile specified, login/password/logcall/"\
-                "mygrid ignored")
+                "mygrid ignored", file=sys.stderr)
     if args.grid in ['none','None','NONE']:
         args.grid = '----'
+    if args.where:
+        try:
+            fields = WhereParser(args.where).parse().fields
+        except ValueError as e:
+            parser.error("Error: --where: " + str(e))
+        if (args.cache or args.db) and not fields <= set(qso_fields):
+            parser.error("Error: --cache and --db don't keep " +
+                ', '.join(sorted(fields - set(qso_fields))) +
+                "; --where can only use " + ', '.join(qso_fields))
+    for k in ('center','neighbors'):
+        if getattr(args, k) and not grid_box(getattr(args, k)):
+            parser.error("Error: --{} {} isn't a grid locator".format(k,
+                getattr(args, k)))
 
     if args.qsl:
         args.qsl = 'yes'
@@ -209,75 +416,368 @@ def getargs():
 
     return args
 ###############################################################################
-# http_get_request -- send data to URL and return response
+# make_session -- build a requests Session with a retrying adapter.  The
+# connection pool holds pool_size connections per host, so that many
+# threads can share one session (and its TCP/TLS connections) instead
+# of setting up a new one for every request.  429 and 503 are retried
+# too, honoring the server's Retry-After, which is how QRZ.com throttles.
 ###############################################################################
-def http_get_request(url,data,ssl=False):
+def make_session(pool_size=10):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     s = requests.Session()
-    retries = Retry(total=6, backoff_factor=0,
-        status_forcelist=[ 502, 503, 504 ])
-    if ssl:
-        s.mount('https://', HTTPAdapter(max_retries=retries))
-    else:
-        s.mount('http://', HTTPAdapter(max_retries=retries))
+    retries = Retry(total=6, backoff_factor=0.5,
+        status_forcelist=[ 429, 502, 503, 504 ])
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size,
+        pool_maxsize=pool_size)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    s.hooks['response'].append(count_http)
+    return s
+
+###############################################################################
+# http_get_request -- send data to URL and return response
+###############################################################################
+http_timeout = 60
 
-    r = s.get(url,params=data)
+def http_get_request(url,data,session=None):
+    if session is None:
+        session = make_session(1)
+    r = session.get(url,params=data,timeout=http_timeout)
     return r.text
 
 ###############################################################################
-# extract_fields -- take input record and split on "<" to separate
-# fields, then do a bit of processing and write to dict
+# RateLimiter -- spread calls out to no more than rate per second, across
+# all threads that share it.  A rate of 0 means no limit.
+###############################################################################
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            when = max(self.next_time, now)
+            self.next_time = when + self.interval
+        if when > now:
+            time.sleep(when - now)
+
 ###############################################################################
+# Metrics -- where a run spends its time.  Each stage of the pipeline
+# runs inside metrics.stage(name), which records its wall and CPU time
+# (CPU includes worker processes) and the peak RSS of the process so far,
+# plus whatever the stage counts: records in and out, bytes read and
+# written, and the HTTP requests made while it ran (count, status codes
+# and a latency histogram per host, from a hook on every session
+# make_session builds).  A stage that runs more than once adds up.  With
+# --metrics_json the lot is written out at the end of the run; with
+# --profile STAGE that stage also runs under cProfile and tracemalloc.
+###############################################################################
+metric_stages = ('get_adifile','sync_adifile','make_logfile.parse',
+    'make_logfile.sort','make_logfile.write','make_logfile.also_sortby',
+    'get_qrz_grids','get_confirmed_grids','get_gridless',
+    'get_unconfirmed_grids','write_grid_stats')
+# upper bounds of the latency histogram buckets, in seconds
+latency_buckets = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+
+def cpu_seconds():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:     # not on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+class Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        m = self.metrics
+        self.st = m.stages.setdefault(self.name, {'calls': 0,
+            'wall_s': 0.0, 'cpu_s': 0.0})
+        self.outer = m.current()
+        m.local.current = self.st
+        if m.profile == self.name:
+            m.start_profile()
+        self.wall = time.perf_counter()
+        self.cpu = cpu_seconds()
+        return self.st
+
+    def __exit__(self, *exc):
+        m = self.metrics
+        st = self.st
+        with m.lock:
+            st['calls'] += 1
+            st['wall_s'] = round(st['wall_s'] + time.perf_counter() -
+                self.wall, 4)
+            st['cpu_s'] = round(st['cpu_s'] + cpu_seconds() - self.cpu, 4)
+        if m.profile == self.name:
+            m.stop_profile(st)
+        st['maxrss_mb'] = peak_rss_mb()
+        m.local.current = self.outer
+        return False
+
+class Metrics:
+    def __init__(self, profile=None):
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        self.wall = time.perf_counter()
+        self.cpu = cpu_seconds()
+        self.stages = {}
+        self.http = {}          # host: counts for the whole run
+        self.local = threading.local()  # .current: the stage dict each
+                                        # thread is counting into
+        self.lock = threading.Lock()
+        self.profile = profile
+        self.profiler = None
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    # current -- the stage dict this thread is counting into, or None
+    def current(self):
+        return getattr(self.local, 'current', None)
+
+    # bind -- fn, to be run on another thread (a pool worker), counting
+    # into this thread's current stage
+    def bind(self, fn):
+        st = self.current()
+        def bound(*args, **kwargs):
+            outer = self.current()
+            self.local.current = st
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.current = outer
+        return bound
+
+    # add -- add n to the current stage's count of key
+    def add(self, key, n):
+        st = self.current()
+        if st is not None:
+            with self.lock:
+                st[key] = st.get(key, 0) + n
+
+    # wrote -- count filename's size as bytes written
+    def wrote(self, filename):
+        self.add('bytes_written', os.path.getsize(filename))
+
+    def http_response(self, r):
+        from urllib.parse import urlsplit
+        host = urlsplit(r.url).netloc
+        secs = r.elapsed.total_seconds()
+        bucket = next((str(b) for b in latency_buckets if secs <= b), 'inf')
+        with self.lock:
+            counts = [self.http.setdefault(host, {})]
+            st = self.current()
+            if st is not None:
+                counts.append(st.setdefault('http',
+                    {}).setdefault(host, {}))
+            for c in counts:
+                c['requests'] = c.get('requests', 0) + 1
+                status = c.setdefault('status', {})
+                status[str(r.status_code)] = \
+                    status.get(str(r.status_code), 0) + 1
+                c['bytes'] = c.get('bytes', 0) + \
+                    int(r.headers.get('Content-Length', 0))
+                c['latency_s'] = round(c.get('latency_s', 0) + secs, 4)
+                c['latency_max_s'] = max(c.get('latency_max_s', 0), secs)
+                hist = c.setdefault('latency_hist', {})
+                hist[bucket] = hist.get(bucket, 0) + 1
+
+    def start_profile(self):
+        import cProfile
+        import tracemalloc
+        if not self.profiler:
+            self.profiler = cProfile.Profile()
+        tracemalloc.start()
+        self.profiler.enable()
+
+    # stop_profile -- write the profile (so far, if the stage runs again)
+    # and the top allocation sites to lotw_tool_profile_<stage>.txt
+    def stop_profile(self, st):
+        self.profiler.disable()
+        import io
+        import pstats
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        st['traced_peak_mb'] = max(st.get('traced_peak_mb', 0),
+            round(peak / (1024 * 1024), 1))
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(
+            'cumulative').print_stats(40)
+        out.write('\nTop allocations (traced peak {:.1f} MB):\n'.format(
+            peak / (1024 * 1024)))
+        for s in snapshot.statistics('lineno')[:20]:
+            out.write(str(s) + '\n')
+        profile_file = 'lotw_tool_profile_' + self.profile + '.txt'
+        with open(profile_file,'w') as f:
+            f.write(out.getvalue())
+        print("Wrote profile of", self.profile, "to", profile_file)
+
+    def report(self):
+        return {'created_by': 'lotw_tool.py v' + version,
+            'started': self.started,
+            'wall_s': round(time.perf_counter() - self.wall, 4),
+            'cpu_s': round(cpu_seconds() - self.cpu, 4),
+            'maxrss_mb': peak_rss_mb(),
+            'stages': self.stages,
+            'http': self.http}
+
+    def write(self, filename):
+        import json
+        with open(filename,'w') as f:
+            json.dump(self.report(), f, indent=1)
+        print("Wrote run metrics to", filename)
+
+metrics = Metrics()
+
+# count_http -- requests response hook feeding metrics (whichever
+# Metrics is current when the response comes in)
+def count_http(r, *args, **kwargs):
+    metrics.http_response(r)
+
+###############################################################################
+# extract_fields -- tokenize input record and write the fields we know
+# about to dict.  Each field header is <NAME:len> or <NAME:len:type>, and
+# the value is exactly len characters following the '>', so anything LoTW
+# tacks on after the value (like its " // QSO Date" comments) is skipped.
+# Headers without a length (<eor>, <eoh>) are passed over.  The record is
+# tokenized by adif_tags.
+###############################################################################
+# ADIF field names are case-insensitive, so look them up by upper case name
+field_index = {k.upper(): k for k in field_keys}
+empty_record = dict.fromkeys(field_keys, None)
+# need to give a default value for sortable fields to
+# avoid breaking python3 sort
+empty_record['GRIDSQUARE'] = '----'
+empty_record['STATE'] = '--'   # Field is only two columns
+
 def extract_fields(record):
-    d = dict.fromkeys(field_keys, None)  # make empty dict
-
-    # need to give a default value for sortable fields to
-    # avoid breaking python3 sort
-    d['GRIDSQUARE'] = '----'
-    d['STATE'] = '--'   # Field is only two columns
-
-    fields = record.split('<')
-    for f in fields:
-        f = str(f.strip())
-        for k in field_keys:
-            if f.startswith(k):
-                   d[k] = str(f.split('>')[1])
-    return d
-                
-###############################################################################
-# format_qso -- format and output QSO record
-###############################################################################
-def format_qso(rec):
-    def make_month(argument):
-        months = {
-            1: "Jan",
-            2: "Feb",
-            3: "Mar",
-            4: "Apr",
-            5: "May",
-            6: "Jun",
-            7: "Jul",
-            8: "Aug",
-            9: "Sep",
-            10: "Oct",
-            11: "Nov",
-            12: "Dec"
-        }   
-        return months.get(argument, "Invalid month")
-
-    year = rec['QSO_DATE'][:4]
-    month = make_month(int(rec['QSO_DATE'][4:6]))
-    day = rec['QSO_DATE'][6:8]
-    date = year + "-" + month + "-" + day
-
-    time = rec['TIME_ON'][:2] + ":" + rec['TIME_ON'][2:4] \
-        + ":" + rec['TIME_ON'][4:6]
-
-    sep = args.separator
-    outrec = "{}T{}{}{}{}{}{}{}{}{}{}{}{}{}{}{}".format(
-            date, time, sep, rec['CALL'], sep, rec['BAND'], 
-            sep, rec['MODE'], sep, rec['QSL_RCVD'], sep, rec['GRIDSQUARE'],
-            sep, rec['STATE'][:2], sep, rec['COUNTRY'])
-    return outrec
+    return adif_tags(record, empty_record.copy(), field_index)
+
+###############################################################################
+# QSO -- compact record for one QSO.  Only the fields used for sorting,
+# output and distances are kept, in slots rather than a per-QSO dict.
+# Values that repeat across the whole log (band, mode, etc.) are interned
+# so every QSO shares one copy of each string.  Item access (rec['CALL']) works
+# as well as attribute access, so a QSO can stand in for a field dict.
+###############################################################################
+qso_fields = ('QSO_DATE','TIME_ON','CALL','BAND','MODE','QSL_RCVD',
+    'GRIDSQUARE','STATE','COUNTRY','MY_GRIDSQUARE')
+# set this to () to turn interning off
+intern_fields = ('BAND','MODE','QSL_RCVD','STATE','COUNTRY','MY_GRIDSQUARE')
+
+class QSO:
+    __slots__ = qso_fields
+
+    def __init__(self, *values):
+        for k, v in zip(qso_fields, values):
+            setattr(self, k, v)
+
+    @classmethod
+    def from_fields(cls, d):
+        return cls.from_values([d[k] for k in qso_fields])
+
+    @classmethod
+    def from_values(cls, values):
+        q = cls(*values)
+        for k in intern_fields:
+            v = getattr(q, k)
+            if v:
+                setattr(q, k, sys.intern(v))
+        return q
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def copy(self):
+        return QSO(*[getattr(self, k) for k in qso_fields])
+
+    def __repr__(self):
+        return 'QSO(' + ', '.join(repr(getattr(self, k))
+            for k in qso_fields) + ')'
+
+###############################################################################
+# format_qso -- format a QSO record as a log line.  Dates and times are
+# turned into text once each and remembered (a log has far fewer
+# distinct dates and times than QSOs), and each separator gets its own
+# format template with the separator built in.  write_qsos does the
+# same for a whole list, a batch of lines per write, pulling each field
+# out column by column with map() so the per-QSO work stays in C.
+###############################################################################
+months = ('Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct',
+    'Nov','Dec')
+
+class DateText(dict):
+    def __missing__(self, qso_date):
+        month = int(qso_date[4:6])
+        month = months[month-1] if 1 <= month <= 12 else "Invalid month"
+        text = self[qso_date] = qso_date[:4] + "-" + month + "-" + \
+            qso_date[6:8]
+        return text
+
+class TimeText(dict):
+    def __missing__(self, time_on):
+        text = self[time_on] = time_on[:2] + ":" + time_on[2:4] + ":" + \
+            time_on[4:6]
+        return text
+
+date_text = DateText()
+time_text = TimeText()
+line_templates = {}
+
+# line_template -- a %-format for one log line, separators built in;
+# %.2s keeps the state to two characters
+def line_template(sep):
+    if sep not in line_templates:
+        s = sep.replace('%','%%')
+        line_templates[sep] = '%sT%s' + s + s.join(['%s'] * 5 +
+            ['%.2s', '%s'])
+    return line_templates[sep]
+
+def format_qso(rec, sep):
+    return line_template(sep) % (date_text[rec.QSO_DATE],
+        time_text[rec.TIME_ON], rec.CALL, rec.BAND, rec.MODE, rec.QSL_RCVD,
+        rec.GRIDSQUARE, rec.STATE, rec.COUNTRY)
+
+def write_qsos(f, qsos, sep, batch=10000, distance=False, center=None):
+    from itertools import islice, repeat
+    fmt = line_template(sep)
+    if distance:
+        fmt += sep.replace('%','%%').join(['', '%s', '%s'])
+    fmt = (fmt + '\n').__mod__
+    qsos = iter(qsos)
+    while True:
+        chunk = list(islice(qsos, batch))
+        if not chunk:
+            break
+        columns = [
+            map(date_text.__getitem__, map(attrgetter('QSO_DATE'), chunk)),
+            map(time_text.__getitem__, map(attrgetter('TIME_ON'), chunk))]
+        columns += [map(attrgetter(k), chunk) for k in ('CALL','BAND',
+            'MODE','QSL_RCVD','GRIDSQUARE','STATE','COUNTRY')]
+        if distance:
+            mygrids = repeat(center) if center else \
+                map(attrgetter('MY_GRIDSQUARE'), chunk)
+            text = list(map(distance_text.__getitem__,
+                zip(mygrids, map(attrgetter('GRIDSQUARE'), chunk))))
+            columns += [map(itemgetter(0), text), map(itemgetter(1), text)]
+        f.write(''.join(map(fmt, zip(*columns))))
 
 ###############################################################################
 # dedupe_list -- sort and remove duplicates from input list
@@ -289,16 +789,19 @@ def dedupe_list(in_list):
     return work
 
 ###############################################################################
-# get_adifile -- download from lotw based on criteria and save as file
+# lotw_query -- build the LoTW report request from args.  With
+# select=False only the login and detail flags are set, which asks for
+# everything logged under args.logcall.
 ###############################################################################
-def get_adifile(args, adifile):
-    print("Sending data request to LoTW...")
-    print("Saving adif data as",adifile,"(this may take a while)...")
+lotw_url = 'https://lotw.arrl.org/lotwuser/lotwreport.adi'
 
+def lotw_query(args, select=True):
     data = { 'login':args.login,'password':args.password,
        'qso_query':'yes','qso_detail':'yes','qso_mydetail':'yes',
        'qso_qsldetail':'yes', 'qso_withown':'yes',
        'qso_logcall':args.logcall}
+    if not select:
+        return data
 
     # add selection criteria if set
     # note: we can't specify QSO grid here, so we filter
@@ -306,8 +809,8 @@ def get_adifile(args, adifile):
     if args.startdate:
         data['qso_startdate'] = args.startdate
     if args.enddate:
-        data['qso_enddate'] = args.startdate
-    if args.qsl:
+        data['qso_enddate'] = args.enddate
+    if args.call:
         data['qso_call'] = args.call
     if args.band:
         data['qso_band'] = args.band
@@ -315,77 +818,1540 @@ def get_adifile(args, adifile):
         data['qso_mode'] = args.mode
     if args.qsl:
         data['qso_qsl'] = args.qsl
+    return data
 
-    base_url = 'https://lotw.arrl.org/lotwuser/lotwreport.adi'
+###############################################################################
+# lotw_chunks -- send a LoTW report request and yield the body as it
+# arrives, in args.chunk_size KB pieces.  A failed or short transfer is
+# tried again (args.retries times, backing off between tries), picking
+# up where it stopped if the server takes Range requests.  If it
+# doesn't, the whole report comes again: None is yielded first so the
+# caller knows to start over.  The body only counts as complete once
+# LoTW's <APP_LoTW_EOF> marker has arrived.
+###############################################################################
+lotw_eof = '<APP_LoTW_EOF>'
+
+def lotw_chunks(args, data, progress=True):
+    import requests
+
+    # progress lines from several accounts at once would be a jumble
+    progress = progress and not args.batch
+    session = make_session(1)
+    have = 0
+    head = tail = b''
+    error = None
+    for attempt in range(args.retries + 1):
+        if attempt:
+            delay = min(2 ** attempt, 60)
+            print("Download failed ({}); retrying in {} seconds...".format(
+                error, delay))
+            time.sleep(delay)
+        try:
+            headers = {'Range': 'bytes={}-'.format(have)} if have else {}
+            # not using http_get_request() because we want to stream
+            r = session.get(lotw_url, params=data, headers=headers,
+                stream=True, timeout=(30, args.timeout))
+            r.raise_for_status()
+            if have and r.status_code != 206:
+                have = 0
+                head = tail = b''
+                yield None
+            start_time = last = time.time()
+            got = 0
+            for chunk in r.iter_content(args.chunk_size * 1024):
+                if len(head) < 64 * 1024:
+                    head += chunk[:64 * 1024 - len(head)]
+                tail = (tail + chunk[-1024:])[-1024:]
+                have += len(chunk)
+                got += len(chunk)
+                metrics.add('bytes_read', len(chunk))
+                yield chunk
+                now = time.time()
+                if progress and now - last >= 1:
+                    last = now
+                    print("\r  {:,.0f} KB, {:,.0f} KB/s   ".format(
+                        have / 1024, got / 1024 / (now - start_time)),
+                        end='', flush=True)
+            if last != start_time:
+                print()
+        except requests.HTTPError as e:
+            if e.response.status_code < 500:
+                exit('LoTW refused the request: ' + str(e))
+            error = e
+            continue
+        except requests.RequestException as e:
+            error = e
+            continue
+
+        if lotw_eof.lower().encode() in tail.lower():
+            session.close()
+            return
+        # a bad login gets an HTML page back, not ADIF
+        if not record_delimiter.search(head.decode('latin1')):
+            exit('LoTW did not return ADIF data; check login and password')
+        error = 'no {} marker; transfer was cut short'.format(lotw_eof)
+    exit('Download from LoTW failed after {} tries: {}'.format(
+        args.retries + 1, error))
 
-    # not using http_get_request() because we want to stream
-    r = requests.get(base_url,params=data, stream=True)
+###############################################################################
+# download_adi -- save a LoTW report as adifile.  The body is written to
+# adifile.part and only renamed into place once it is complete, so a
+# dropped connection never leaves a truncated file to be parsed.
+###############################################################################
+def download_adi(args, data, adifile, progress=True):
+    partfile = adifile + '.part'
+    try:
+        with open(partfile,'wb') as f:
+            for chunk in lotw_chunks(args, data, progress):
+                if chunk is None:
+                    f.seek(0)
+                    f.truncate()
+                else:
+                    f.write(chunk)
+    except SystemExit:
+        Path(partfile).unlink(missing_ok=True)
+        raise
+    Path(partfile).replace(adifile)
 
-    with open(adifile,'wb') as f:
-        for data in r.iter_content(4096):
-            f.write(data)
+###############################################################################
+# stream_adi -- like download_adi, but yield the raw ADIF records as the
+# body arrives so they can be parsed while the rest is still coming.
+# With teefile, the body is saved there as well.  If a retry has to
+# start the report over, the part already parsed is skipped.
+###############################################################################
+def stream_adi(args, data, teefile=None):
+    parsed = skip = 0
+    tee = open(teefile + '.part','wb') if teefile else None
+
+    def text():
+        nonlocal parsed, skip
+        for chunk in lotw_chunks(args, data):
+            if chunk is None:
+                skip = parsed
+                if tee:
+                    tee.seek(0)
+                    tee.truncate()
+                continue
+            if tee:
+                tee.write(chunk)
+            if skip:
+                drop = min(skip, len(chunk))
+                chunk = chunk[drop:]
+                skip -= drop
+            parsed += len(chunk)
+            # latin1 is one byte per character, so any split is safe
+            yield chunk.decode('latin1')
+
+    try:
+        yield from read_adif_records(text())
+    except SystemExit:
+        if tee:
+            tee.close()
+            Path(teefile + '.part').unlink()
+        raise
+    if tee:
+        tee.close()
+        Path(teefile + '.part').replace(teefile)
+
+###############################################################################
+# get_adifile -- download from lotw based on criteria and save as file
+###############################################################################
+def get_adifile(args, adifile):
+    print("Sending data request to LoTW...")
+    print("Saving adif data as",adifile,"(this may take a while)...")
+    if args.shards > 1:
+        download_shards(args, lotw_query(args), adifile)
+    else:
+        download_adi(args, lotw_query(args), adifile)
+
+# stream_adifile -- the same request, as records to parse on the fly
+def stream_adifile(args, adifile):
+    print("Sending data request to LoTW...")
+    print("Processing records as they arrive (this may take a while)...")
+    if args.keep_adi:
+        print("Saving adif data as",adifile)
+    return stream_adi(args, lotw_query(args),
+        adifile if args.keep_adi else None)
 
 ###############################################################################
-# make_logfile -- process adifile to logfile format
+# read_adif_records -- take text chunks (file reads or HTTP body pieces)
+# and yield one raw ADIF record at a time, split on <eor> or <eoh>.
+# Only the unfinished tail of the last chunk is carried over, so memory
+# use doesn't depend on the size of the file.
 ###############################################################################
-def make_logfile(args,adifile,logfile):
+record_delimiter = re.compile('<eo[rh]>', re.IGNORECASE)
+read_size = 1024 * 1024
+
+def read_adif_records(chunks):
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        for m in record_delimiter.finditer(buf):
+            yield buf[start:m.start()]
+            start = m.end()
+        buf = buf[start:]
+    if buf.strip():
+        yield buf
+
+def read_adifile(adifile):
     with open(adifile,encoding='latin1') as f:
-        qso_list = []   # this will be the list of QSOs logged
-        record_delimiter = "<eo" # could be '<eoh>' or '<eor>'
-    
-        buf = f.read()
-        buf = buf.split(record_delimiter)
-        for q in buf:
-            d = extract_fields(q)
-            while d['CALL']:    # without a call, it's not real
-
-                # can't select for these fields in the LoTW request,
-                # so filter for them here
-
-                # print only if my grid matches
-                if args.mygrid:
-                    if args.mygrid not in d['MY_GRIDSQUARE']:
-                        break
-
-                # if --dx_only, exclude records where country is U.S.A.
-                if args.dx_only == 'yes' and \
-                    d['COUNTRY'] == "UNITED STATES OF AMERICA":
-                        break
-
-                # print only if QSO grid matches, or if specified
-                # "None" then only if there is no grid in record
-                if args.grid:
-                    if args.grid == "----" and not d['GRIDSQUARE']:
-                        qso_list.append(d)
-                    elif d['GRIDSQUARE'] and args.grid in d['GRIDSQUARE']:
-                        qso_list.append(d)
-                    break
-                    
-                # if noqsl, exclude records where QSL_RCVD is Y
-                if args.noqsl:
-                    if args.noqsl == 'yes' and d['QSL_RCVD'] == 'Y':
-                        break
-    
-                qso_list.append(d)
-                break
-    
-    # sort by 'CALL','GRIDSQUARE', 'STATE', 'COUNTRY', 'BAND', or 'MODE'
-    # first, then by date and time
+        yield from read_adif_records(iter(lambda: f.read(read_size), ''))
 
-    if args.sortby:
-        sorted_by = sorted(qso_list, key = lambda i: (i[args.sortby],
-        i['QSO_DATE'], i['TIME_ON']))
+###############################################################################
+# adif_tags -- walk an ADIF record and return a dict of NAME: value for
+# every field in it, names upper case.  See extract_fields for the format;
+# this is the one place it's parsed.  Given tags, the fields go into that
+# dict instead; given names, only the fields named in it are kept, under
+# the name it maps them to.
+###############################################################################
+def adif_tags(record, tags=None, names=None):
+    if tags is None:
+        tags = {}
+    get = names.get if names is not None else None
+    find = record.find
+    pos = 0
+    while True:
+        start = find('<', pos)
+        if start < 0:
+            break
+        end = find('>', start)
+        if end < 0:
+            break
+        spec = record[start+1:end].split(':')
+        pos = end + 1
+        if len(spec) < 2 or not spec[1].isdigit():
+            continue
+        length = int(spec[1])
+        name = spec[0].upper()
+        if get:
+            name = get(name)
+        if name:
+            tags[name] = record[pos:pos+length]
+        pos += length
+    return tags
+
+# read_adif_header -- tags from the part of adifile before <eoh>
+def read_adif_header(adifile):
+    for record in read_adifile(adifile):
+        return adif_tags(record)
+    return {}
+
+###############################################################################
+# Incremental sync.  A master ADI file holds everything LoTW has for
+# args.logcall, and its header records how far it's up to date:
+# APP_LoTW_LASTQSORX is the last time LoTW received one of our QSOs and
+# APP_LoTW_LASTQSL the last time it received a QSL.  Each sync asks
+# LoTW only for QSOs received since the one and QSLs received since the
+# other, then merges them into the master by QSO identity.
+###############################################################################
+# qso_identity -- what makes two records the same QSO
+def qso_identity(d):
+    return tuple((d[k] or '').upper() for k in
+        ('CALL','QSO_DATE','TIME_ON','BAND','MODE'))
+
+# record_identity -- qso_identity straight from a raw record, for when
+# nothing else in it is needed; much quicker than extract_fields
+identity_patterns = [re.compile('<' + k + r':(\d+)[^>]*>', re.IGNORECASE)
+    for k in ('CALL','QSO_DATE','TIME_ON','BAND','MODE')]
+
+def record_identity(record):
+    key = []
+    for p in identity_patterns:
+        m = p.search(record)
+        key.append(record[m.end():m.end()+int(m.group(1))].upper()
+            if m else '')
+    return tuple(key)
+
+# adif_date -- YYYYMMDD to the YYYY-MM-DD form LoTW queries want
+def adif_date(s):
+    return s[:4] + '-' + s[4:6] + '-' + s[6:8]
+
+# write_adif_header -- a LoTW-style header carrying the watermark tags
+watermark_tags = (('APP_LOTW_LASTQSORX','APP_LoTW_LASTQSORX'),
+                  ('APP_LOTW_LASTQSL','APP_LoTW_LASTQSL'))
+
+def write_adif_header(f, title, header, num_records):
+    f.write("ARRL Logbook of the World Status Report\n")
+    f.write(title + " lotw_tool.py v" + version + "\n\n")
+    f.write("<PROGRAMID:4>LoTW\n")
+    for k, name in watermark_tags:
+        if k in header:
+            f.write("<{}:{}>{}\n".format(name, len(header[k]), header[k]))
+    n = str(num_records)
+    f.write("<APP_LoTW_NUMREC:" + str(len(n)) + ">" + n + "\n\n<eoh>\n\n")
+
+def merge_adifiles(master, deltas, logcall):
+    records = {}
+    header = {}
+    for adifile in [master] + deltas:
+        if not Path(adifile).exists():
+            continue
+        for record in read_adifile(adifile):
+            d = extract_fields(record)
+            if not d['CALL']:
+                # the header, or trailing <APP_LoTW_EOF>
+                for k, v in adif_tags(record).items():
+                    if k in dict(watermark_tags):
+                        header[k] = max(header.get(k, ''), v)
+                continue
+            # later files win, but the QSO keeps its place in the log
+            records[qso_identity(d)] = record.strip()
+            if d['QSLRDATE']:
+                header['APP_LOTW_LASTQSL'] = max(
+                    header.get('APP_LOTW_LASTQSL', ''), adif_date(d['QSLRDATE']))
+
+    tmpfile = master + '.tmp'
+    with open(tmpfile,'w',encoding='latin1') as f:
+        write_adif_header(f, "Master log for " + logcall + " kept by",
+            header, len(records))
+        for record in records.values():
+            f.write(record + "\n<eor>\n\n")
+    Path(tmpfile).replace(master)
+    return len(records)
+
+def sync_adifile(args, master):
+    data = lotw_query(args, select=False)
+    state = read_adif_header(master) if Path(master).exists() else None
+    deltas = []
+    if state is None:
+        print("No master log yet; downloading all QSOs to",master,
+            "(this may take a while)...")
+        # every QSL up to now comes with this download
+        data['qso_qsl'] = 'no'
+        deltas.append(master + '.full')
+        if args.shards > 1:
+            download_shards(args, data, deltas[-1])
+        else:
+            download_adi(args, data, deltas[-1])
     else:
-        sorted_by = sorted(qso_list, key = lambda i: (i['QSO_DATE'], i['TIME_ON']))
+        since = state.get('APP_LOTW_LASTQSORX', '1900-01-01')
+        print("Fetching QSOs received by LoTW since", since)
+        deltas.append(master + '.qsos')
+        download_adi(args, dict(data, qso_qsl='no', qso_qsorxsince=since),
+            deltas[-1])
+        since = state.get('APP_LOTW_LASTQSL', '1900-01-01')
+        print("Fetching QSLs received by LoTW since", since)
+        deltas.append(master + '.qsls')
+        download_adi(args, dict(data, qso_qsl='yes', qso_qslsince=since),
+            deltas[-1])
+
+    num = merge_adifiles(master, deltas, args.logcall)
+    for d in deltas:
+        Path(d).unlink()
+    print("Master log",master,"now has",num,"QSOs")
+
+###############################################################################
+# Sharded download.  LoTW takes a long time to build one big report, but
+# it will work on several smaller ones at once, so download_shards splits
+# the date range into args.shards windows, fetches them args.shard_workers
+# at a time, and joins the pieces into adifile.  LoTW's qso_enddate is
+# inclusive, so each window ends the day before the next one starts.
+# With no --startdate the first window is open at the bottom, and with
+# no --enddate the last one is open at the top.
+###############################################################################
+lotw_opened = date(2003, 9, 1)
+
+def shard_windows(startdate, enddate, num_shards):
+    try:
+        first = date.fromisoformat(startdate) if startdate else lotw_opened
+        last = date.fromisoformat(enddate) if enddate else date.today()
+    except ValueError:
+        exit('--shards needs --startdate and --enddate as YYYY-MM-DD')
+    days = (last - first).days + 1
+    num_shards = max(1, min(num_shards, days))
+    bounds = [first + timedelta(days=days * i // num_shards)
+        for i in range(num_shards + 1)]
+    windows = [[str(bounds[i]), str(bounds[i+1] - timedelta(days=1))]
+        for i in range(num_shards)]
+    windows[0][0] = startdate
+    windows[-1][1] = enddate
+    return windows
+
+def download_shards(args, data, adifile):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    windows = shard_windows(data.get('qso_startdate'),
+        data.get('qso_enddate'), args.shards)
+    shardfiles = []
+    jobs = {}
+    print("Fetching {} date ranges, {} at a time".format(len(windows),
+        args.shard_workers))
+    with ThreadPoolExecutor(args.shard_workers) as pool:
+        for i, (start, end) in enumerate(windows):
+            shard = dict(data)
+            shard.pop('qso_startdate', None)
+            shard.pop('qso_enddate', None)
+            if start:
+                shard['qso_startdate'] = start
+            if end:
+                shard['qso_enddate'] = end
+            shardfiles.append(adifile + '.shard{}'.format(i))
+            jobs[pool.submit(metrics.bind(download_adi), args, shard,
+                shardfiles[-1], False)] = (start or 'the beginning', end or 'now')
+        for job in as_completed(jobs):
+            job.result()
+            print("  got {} to {}".format(*jobs[job]))
+
+    num = join_shards(adifile, shardfiles)
+    for s in shardfiles:
+        Path(s).unlink()
+    print("Joined",num,"QSOs into",adifile)
+
+# join_shards -- copy the shard records into adifile in date order,
+# dropping any QSO seen already.  Records are streamed to a body file
+# and the header, which needs the count, is written in front of it.
+def join_shards(adifile, shardfiles):
+    import shutil
+
+    header = {}
+    seen = set()
+    bodyfile = adifile + '.body'
+    with open(bodyfile,'w',encoding='latin1') as body:
+        for shardfile in shardfiles:
+            for record in read_adifile(shardfile):
+                key = record_identity(record)
+                if not key[0]:
+                    for k, v in adif_tags(record).items():
+                        if k in dict(watermark_tags):
+                            header[k] = max(header.get(k, ''), v)
+                    continue
+                if key in seen:
+                    continue
+                seen.add(key)
+                body.write(record.strip() + "\n<eor>\n\n")
+
+    tmpfile = adifile + '.tmp'
+    with open(tmpfile,'w',encoding='latin1') as f:
+        write_adif_header(f, "Joined from {} LoTW reports by".format(
+            len(shardfiles)), header, len(seen))
+        with open(bodyfile,encoding='latin1') as body:
+            shutil.copyfileobj(body, f)
+        f.write(lotw_eof + "\n")
+    Path(bodyfile).unlink()
+    Path(tmpfile).replace(adifile)
+    return len(seen)
+
+###############################################################################
+# Locators.  grid_box turns a 2, 4, 6 or 8 character Maidenhead locator
+# into its cell (south edge, west edge, height, width in degrees) and
+# grid_latlon remembers the center of each locator it's asked about.
+# distance_bearing is the great circle distance (km) and initial bearing
+# (degrees) from one point to another, and grid_distance remembers it
+# for each (from grid, to grid) pair.
+#
+# A log has far fewer distinct grids than QSOs, so the distance filters
+# don't do any geometry per QSO: GeoFilter keeps a dict of (grid, my grid)
+# pairs, in effect buckets of QSOs by location, and each pair is tested
+# once, the first time a QSO from that bucket comes along.  Every QSO
+# after that is one dict lookup.
+###############################################################################
+earth_radius = 6371.0   # km
+grid_chars = ('ABCDEFGHIJKLMNOPQR', '0123456789', 'ABCDEFGHIJKLMNOPQRSTUVWX',
+    '0123456789')
+
+def grid_box(grid):
+    if not grid or len(grid) not in (2, 4, 6, 8):
+        return None
+    grid = grid.upper()
+    south, west, height, width = -90.0, -180.0, 180.0, 360.0
+    for i in range(0, len(grid), 2):
+        chars = grid_chars[i // 2]
+        x = chars.find(grid[i])
+        y = chars.find(grid[i+1])
+        if x < 0 or y < 0:
+            return None
+        height /= len(chars)
+        width /= len(chars)
+        south += y * height
+        west += x * width
+    return south, west, height, width
+
+class GridLatLon(dict):
+    def __missing__(self, grid):
+        box = grid_box(grid)
+        latlon = self[grid] = box and (box[0] + box[2] / 2,
+            box[1] + box[3] / 2)
+        return latlon
+
+grid_latlon = GridLatLon()
+
+def distance_bearing(lat1, lon1, lat2, lon2):
+    lat1, lat2 = radians(lat1), radians(lat2)
+    dlon = radians(lon2 - lon1)
+    a = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    km = 2 * earth_radius * asin(min(1.0, sqrt(a)))
+    bearing = degrees(atan2(sin(dlon) * cos(lat2),
+        cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon))) % 360
+    return km, bearing
+
+# grid_distance[mygrid, grid] -- (km, bearing), or None if either grid
+# isn't a locator
+class GridDistance(dict):
+    def __missing__(self, key):
+        here = grid_latlon[key[0]]
+        there = grid_latlon[key[1]]
+        result = self[key] = here and there and \
+            distance_bearing(here[0], here[1], there[0], there[1])
+        return result
+
+grid_distance = GridDistance()
+
+# distance_text[mygrid, grid] -- km and bearing as log columns
+class DistanceText(dict):
+    def __missing__(self, key):
+        d = grid_distance[key]
+        text = self[key] = ('%.0f' % d[0], '%03d' % (round(d[1]) % 360)) \
+            if d else ('', '')
+        return text
+
+distance_text = DistanceText()
+
+# in_box -- is lat/lon inside the box?  The box runs east from west to
+# east, so it can cross the 180th meridian.
+def in_box(lat, lon, south, west, north, east):
+    return south <= lat <= north and \
+        (lon - west) % 360 <= (east - west) % 360
+
+# GeoFilter.keep(grid, mygrid) -- True if a QSO with that grid is kept
+# by --within (distance from center, or from my grid if there's no
+# center), --bbox and --neighbors.  A QSO without a usable grid is never
+# kept.
+class GeoFilter:
+    def __init__(self, within=None, center=None, bbox=None, neighbors=None):
+        self.kept = {}      # (grid, mygrid): True/False
+        self.within = within
+        self.center = center
+        self.bbox = None
+        if bbox:
+            lat1, lon1, lat2, lon2 = bbox
+            self.bbox = (min(lat1, lat2), lon1, max(lat1, lat2), lon2)
+        # the neighbors' cell plus one cell all around it
+        self.near = None
+        if neighbors:
+            south, west, height, width = grid_box(neighbors)
+            self.near = (south - height, west - width, south + 2 * height,
+                west + 2 * width)
+
+    def keep(self, grid, mygrid):
+        kept = self.kept.get((grid, mygrid))
+        if kept is None:
+            kept = self.kept[grid, mygrid] = self.test(grid, mygrid)
+        return kept
+
+    def test(self, grid, mygrid):
+        latlon = grid_latlon[grid]
+        if not latlon:
+            return False
+        if self.within is not None:
+            d = grid_distance[self.center or mygrid, grid]
+            if not d or d[0] > self.within:
+                return False
+        if self.bbox and not in_box(*latlon, *self.bbox):
+            return False
+        if self.near and not in_box(*latlon, *self.near):
+            return False
+        return True
+
+# geo_filter -- the GeoFilter for args, or None if no distance options
+# are given.  The filters are kept here rather than on args, so they're
+# built once per process and args still pickles and prints as it did.
+# With memo off, a new one is built and not kept.
+geo_filters = {}
+
+def geo_filter(args, memo=True):
+    if args.within is None and not args.bbox and not args.neighbors:
+        return None
+    key = (args.within, args.center, tuple(args.bbox or ()), args.neighbors)
+    if not memo:
+        return GeoFilter(*key)
+    if key not in geo_filters:
+        geo_filters[key] = GeoFilter(*key)
+    return geo_filters[key]
+
+###############################################################################
+# Where expressions.  --where selects QSOs by their ADIF fields, e.g.
+#     BAND in (6M,2M) and GRIDSQUARE is null and QSO_DATE >= 20180101
+# A condition is FIELD op VALUE (op is = != < <= > >=), FIELD [not] in
+# (VALUE,...), FIELD is [not] null or FIELD contains VALUE, and they
+# combine with and, or, not and parentheses.  Words are case-insensitive,
+# values aren't; quote a value with spaces or punctuation in it.  Values
+# compare as text (dates as YYYYMMDD, the dashes are optional) except in
+# the numeric fields.  A field that's missing, empty or the '----'/'--'
+# placeholder is null, and a null field is != and not in anything.
+#
+# The expression is parsed once into a tree of Where nodes, each of which
+# compiles its test of an extracted record into a closure.  --mygrid,
+# --dx_only, --grid, --noqsl and the distance options are and-ed on as
+# nodes of their own, so whatever the options there's one predicate.
+# Nodes also offer a quick test of the raw record text: a value the QSO
+# must have has to appear in the record right after some tag's '>', and
+# a < or > comparison only needs the one field a regex can pull out.
+# Either is far cheaper than extract_fields, and records failing the
+# quick test are dropped without being parsed.  The quick test can let a
+# record through that the real test drops, but not the other way round.
+###############################################################################
+where_number_fields = ('APP_LoTW_NUMREC','CQZ','DXCC','FREQ','ITUZ',
+    'MY_CQ_ZONE','MY_DXCC','MY_ITU_ZONE')
+where_date_fields = ('QSLRDATE','QSO_DATE')
+where_ops = {'=': operator.eq, '==': operator.eq, '!=': operator.ne,
+    '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge}
+
+def where_number(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+# all_of, any_of -- chain tests into one, stopping at the first that
+# settles it
+def all_of(tests):
+    test = tests[0]
+    for t in tests[1:]:
+        test = (lambda a, b: lambda x: a(x) and b(x))(test, t)
+    return test
+
+def any_of(tests):
+    test = tests[0]
+    for t in tests[1:]:
+        test = (lambda a, b: lambda x: a(x) or b(x))(test, t)
+    return test
+
+# WhereCond -- one condition on one field
+class WhereCond:
+    def __init__(self, field, op, values=()):
+        if field in where_date_fields:
+            values = [v.replace('-', '') for v in values]
+        if field in where_number_fields and op not in ('contains',
+                'is null', 'is not null'):
+            for v in values:
+                if where_number(v) is None:
+                    raise ValueError("{} {} needs a number, not {!r}".format(
+                        field, op, v))
+        self.field = field
+        self.op = op
+        self.values = values
+        self.fields = {field}
+        self.test = self.make_test()
+        self.quick = self.make_quick()
+
+    def make_test(self):
+        k = self.field
+        op = self.op
+        nulls = (None, '', empty_record[k])
+        if op == 'is null':
+            return lambda d: d[k] in nulls
+        if op == 'is not null':
+            return lambda d: d[k] not in nulls
+        if op == 'contains':
+            x = self.values[0]
+            return lambda d: d[k] is not None and x in d[k]
+        if k in where_number_fields:
+            values = [where_number(v) for v in self.values]
+            get = lambda d: where_number(d[k])
+        else:
+            values = self.values
+            get = itemgetter(k)
+        if op == 'in':
+            values = frozenset(values)
+            return lambda d: get(d) in values
+        if op == 'not in':
+            values = frozenset(values)
+            return lambda d: get(d) not in values
+        compare = where_ops[op]
+        x = values[0]
+        if op in ('=', '==', '!=', '<>'):
+            return lambda d: compare(get(d), x)
+        # nothing is less or greater than null
+        def test(d):
+            if d[k] in nulls:
+                return False
+            v = get(d)
+            return v is not None and compare(v, x)
+        return test
+
+    def make_quick(self):
+        k = self.field
+        op = self.op
+        default = empty_record[k] or ''
+        if op == 'contains':
+            x = self.values[0]
+            if not x or x in default:
+                return None
+            return lambda r: x in r
+        # numbers can be written more than one way
+        if k in where_number_fields:
+            return None
+        # for < and >, find the field's tag with a regex and compare the
+        # value after it.  A record where the tag isn't found is let
+        # through for the real test to decide.
+        if op in ('<', '<=', '>', '>='):
+            compare = where_ops[op]
+            x = self.values[0]
+            find = re.compile(r'<(?i:' + re.escape(k) +
+                r'):(\d+)[^>]*>').search
+            def quick(r):
+                m = find(r)
+                if not m:
+                    return True
+                return compare(r[m.end():m.end() + int(m.group(1))], x)
+            return quick
+        if op not in ('=', '==', 'in'):
+            return None
+        if any(v in ('', default) for v in self.values):
+            return None
+        needles = ['>' + v for v in self.values]
+        if len(needles) == 1:
+            x = needles[0]
+            return lambda r: x in r
+        return re.compile('|'.join(map(re.escape, needles))).search
+
+class WhereAnd:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.fields = set().union(*[n.fields for n in nodes])
+        self.test = all_of([n.test for n in nodes])
+        quicks = [n.quick for n in nodes if n.quick]
+        self.quick = all_of(quicks) if quicks else None
+
+class WhereOr:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.fields = set().union(*[n.fields for n in nodes])
+        self.test = any_of([n.test for n in nodes])
+        quicks = [n.quick for n in nodes]
+        self.quick = any_of(quicks) if all(quicks) else None
+
+class WhereNot:
+    def __init__(self, node):
+        self.node = node
+        self.fields = node.fields
+        test = node.test
+        self.test = lambda d: not test(d)
+        self.quick = None
+
+# WhereGeo -- the distance options, as a node
+class WhereGeo:
+    def __init__(self, geo):
+        self.fields = {'GRIDSQUARE', 'MY_GRIDSQUARE'}
+        keep = geo.keep
+        self.test = lambda d: keep(d['GRIDSQUARE'], d['MY_GRIDSQUARE'])
+        self.quick = None
+
+# where_tokens -- split an expression into ('op', text), ('value', text)
+# for quoted values and ('word', text) for everything else
+where_token = re.compile(r"""\s*(?:(<=|>=|!=|<>|==|[=<>(),])"""
+    r"""|'([^']*)'|"([^"]*)"|([^\s()<>=!,'"]+))""")
+
+def where_tokens(text):
+    tokens = []
+    text = text.rstrip()
+    pos = 0
+    while pos < len(text):
+        m = where_token.match(text, pos)
+        if not m:
+            raise ValueError("can't make sense of {!r}".format(text[pos:]))
+        op, single, double, word = m.groups()
+        if op:
+            tokens.append(('op', op))
+        elif word:
+            tokens.append(('word', word))
+        else:
+            tokens.append(('value', double if single is None else single))
+        pos = m.end()
+    return tokens
+
+# WhereParser -- recursive descent, lowest precedence first:
+#     or_expr   := and_expr ('or' and_expr)*
+#     and_expr  := not_expr ('and' not_expr)*
+#     not_expr  := 'not' not_expr | '(' or_expr ')' | condition
+# Errors are ValueErrors saying what was expected.
+class WhereParser:
+    def __init__(self, text):
+        self.tokens = where_tokens(text)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, 'end of expression')
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    # keyword -- take the next token if it's one of words
+    def keyword(self, *words):
+        kind, text = self.peek()
+        if kind == 'word' and text.lower() in words:
+            self.pos += 1
+            return text.lower()
+        return None
+
+    def expect(self, op):
+        if self.next() != ('op', op):
+            raise ValueError("expected {!r} before {}".format(op,
+                self.tokens[self.pos - 1][1] if self.pos <= len(self.tokens)
+                else 'end of expression'))
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError("unexpected {!r}".format(self.peek()[1]))
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.keyword('or'):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else WhereOr(nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.keyword('and'):
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else WhereAnd(nodes)
+
+    def parse_not(self):
+        if self.keyword('not'):
+            return WhereNot(self.parse_not())
+        if self.peek() == ('op', '('):
+            self.pos += 1
+            node = self.parse_or()
+            self.expect(')')
+            return node
+        return self.parse_cond()
+
+    def parse_cond(self):
+        kind, text = self.next()
+        k = field_index.get(text.upper()) if kind == 'word' else None
+        if not k:
+            raise ValueError("expected a field name, not {!r}".format(text))
+        if self.keyword('is'):
+            op = 'is not null' if self.keyword('not') else 'is null'
+            if not self.keyword('null'):
+                raise ValueError("expected null after {} is".format(k))
+            return WhereCond(k, op)
+        negate = self.keyword('not')
+        if self.keyword('in'):
+            self.expect('(')
+            values = [self.value()]
+            while self.peek() == ('op', ','):
+                self.pos += 1
+                values.append(self.value())
+            self.expect(')')
+            return WhereCond(k, 'not in' if negate else 'in', values)
+        if negate:
+            raise ValueError("expected in after {} not".format(k))
+        if self.keyword('contains'):
+            return WhereCond(k, 'contains', [self.value()])
+        kind, op = self.next()
+        if kind != 'op' or op not in where_ops:
+            raise ValueError("expected a comparison after {}, not {!r}".format(
+                k, op))
+        return WhereCond(k, op, [self.value()])
+
+    def value(self):
+        kind, text = self.next()
+        if kind not in ('word', 'value'):
+            raise ValueError("expected a value, not {!r}".format(text))
+        return text
+
+# where_filter -- the one Where node for all of args' selections, memoized
+# like geo_filter (memo off builds a new one, for a --serve request, so
+# the memos don't keep every query the server is ever sent).  The CALL
+# test comes first: without a call, it's not real.
+where_filters = {}
+
+def where_filter(args, memo=True):
+    key = (args.where, args.mygrid, args.dx_only, args.grid, args.noqsl,
+        args.within, args.center, tuple(args.bbox or ()), args.neighbors)
+    if key not in where_filters or not memo:
+        nodes = [WhereCond('CALL', 'is not null')]
+        # print only if my grid matches
+        if args.mygrid:
+            nodes.append(WhereCond('MY_GRIDSQUARE', 'contains',
+                [args.mygrid]))
+        # if --dx_only, exclude records where country is U.S.A.
+        if args.dx_only == 'yes':
+            nodes.append(WhereCond('COUNTRY', '!=',
+                ['UNITED STATES OF AMERICA']))
+        # print only if QSO grid matches, or if specified
+        # "None" then only if there is no grid in record
+        if args.grid:
+            nodes.append(WhereCond('GRIDSQUARE', 'contains', [args.grid]))
+        # if noqsl, exclude records where QSL_RCVD is Y
+        if args.noqsl == 'yes':
+            nodes.append(WhereCond('QSL_RCVD', '!=', ['Y']))
+        if args.where:
+            nodes.append(WhereParser(args.where).parse())
+        # --within, --bbox and --neighbors
+        geo = geo_filter(args, memo)
+        if geo:
+            nodes.append(WhereGeo(geo))
+        if not memo:
+            return WhereAnd(nodes)
+        where_filters[key] = WhereAnd(nodes)
+    return where_filters[key]
+
+###############################################################################
+# qso_filter -- apply the selections LoTW can't do for us to an
+# extracted record.  Returns True if the QSO should be kept.
+###############################################################################
+def qso_filter(args, d):
+    return where_filter(args).test(d)
+
+# filter_records -- the extracted fields of the records that pass the
+# filters.  With count set, the number of records read and the number
+# that got past the quick test and had to be parsed are added to the
+# current metrics stage.
+def filter_records(args, records, count=False):
+    where = where_filter(args)
+    quick = where.quick
+    test = where.test
+    read = parsed = 0
+    if quick is None:
+        for read, record in enumerate(records, 1):
+            d = extract_fields(record)
+            if test(d):
+                yield d
+        parsed = read
+    else:
+        for read, record in enumerate(records, 1):
+            if quick(record):
+                parsed += 1
+                d = extract_fields(record)
+                if test(d):
+                    yield d
+    if count:
+        metrics.add('records_in', read)
+        metrics.add('records_parsed', parsed)
+
+###############################################################################
+# QSO database.  With --db, the ADI file is loaded once into an SQLite
+# table with one column per QSO field, indexed on the fields we select
+# by.  Reports are then queries against that table.
+# The database remembers which file it was loaded from (path, size and
+# mtime) and reloads itself if that changes.  Without adifile, the
+# database is used as it stands.
+###############################################################################
+db_columns = qso_fields
+db_indexes = ('CALL','GRIDSQUARE','BAND','MODE','QSO_DATE','COUNTRY',
+    'QSL_RCVD')
+
+def open_qso_db(dbfile, adifile=None):
+    import sqlite3
+    db = sqlite3.connect(str(Path(dbfile).expanduser()))
+    db.execute('CREATE TABLE IF NOT EXISTS source (adifile TEXT, '\
+        'size INTEGER, mtime REAL)')
+    if adifile is None:
+        return db
+    st = os.stat(adifile)
+    source = (str(Path(adifile).resolve()), st.st_size, st.st_mtime)
+    if db.execute('SELECT * FROM source').fetchone() != source:
+        import_qsos(db, adifile, source)
+    return db
+
+def import_qsos(db, adifile, source):
+    print("Loading",adifile,"into QSO database...")
+    db.execute('DROP TABLE IF EXISTS qso')
+    db.execute('CREATE TABLE qso (' + ','.join(db_columns) + ')')
+    rows = ([d[k] for k in db_columns] for d in map(extract_fields,
+        read_adifile(adifile)) if d['CALL'])
+    db.executemany('INSERT INTO qso VALUES (' +
+        ','.join('?' * len(db_columns)) + ')', rows)
+    for k in db_indexes:
+        db.execute('CREATE INDEX qso_{0} ON qso ({0})'.format(k))
+    db.execute('DELETE FROM source')
+    db.execute('INSERT INTO source VALUES (?,?,?)', source)
+    db.commit()
+
+# db_where -- SQL for the output filters.  These are the same tests as
+# qso_filter (the distance tests call GeoFilter from SQL as geo_keep, and
+# --where calls its compiled test as where_keep),
+# plus --call, --band, --mode and the dates, which otherwise only select
+# what LoTW sends.
+def db_where(args):
+    conds = []
+    params = []
+    if args.mygrid:
+        conds.append('instr(MY_GRIDSQUARE, ?) > 0')
+        params.append(args.mygrid)
+    if args.dx_only == 'yes':
+        conds.append("COUNTRY IS NOT 'UNITED STATES OF AMERICA'")
+    if args.grid:
+        conds.append('instr(GRIDSQUARE, ?) > 0')
+        params.append(args.grid)
+    if args.noqsl == 'yes':
+        conds.append("QSL_RCVD IS NOT 'Y'")
+    if geo_filter(args):
+        conds.append('geo_keep(GRIDSQUARE, MY_GRIDSQUARE)')
+    if args.where:
+        conds.append('where_keep(' +
+            ','.join(sorted(WhereParser(args.where).parse().fields)) + ')')
+    for k in ('call','band','mode'):
+        if getattr(args, k):
+            conds.append(k.upper() + ' = ?')
+            params.append(getattr(args, k))
+    if args.startdate:
+        conds.append('QSO_DATE >= ?')
+        params.append(args.startdate.replace('-', ''))
+    if args.enddate:
+        conds.append('QSO_DATE <= ?')
+        params.append(args.enddate.replace('-', ''))
+    if not conds:
+        return '', params
+    return ' WHERE ' + ' AND '.join(conds), params
+
+def query_qsos(db, args):
+    geo = geo_filter(args)
+    if geo:
+        db.create_function('geo_keep', 2, geo.keep)
+    if args.where:
+        node = WhereParser(args.where).parse()
+        fields = sorted(node.fields)
+        db.create_function('where_keep', len(fields),
+            lambda *v: node.test(dict(zip(fields, v))))
+    where, params = db_where(args)
+    order = ['QSO_DATE', 'TIME_ON']
+    if args.sortby:
+        order.insert(0, args.sortby)
+    rows = db.execute('SELECT ' + ','.join(qso_fields) + ' FROM qso' +
+        where + ' ORDER BY ' + ','.join(order), params)
+    return [QSO(*row) for row in rows]
+
+###############################################################################
+# Column cache.  With --cache, the first run on an ADI file saves the
+# parsed QSOs next to it as adifile.cache, one column per field: a sorted
+# table of the field's distinct values and an array of 32-bit codes into
+# that table (code 0 is None).  Later runs mmap the cache and filter on
+# the codes, testing each distinct value once, instead of parsing the
+# ADI text again.  The cache records the ADI file's size, mtime and
+# SHA-256.  If the size and mtime match it's used as is; if only the
+# mtime differs the file is hashed to see whether it really changed;
+# otherwise it's rebuilt.
+###############################################################################
+cache_magic = b'LOTWQC1\n'
+cache_fields = qso_fields
+
+class QSOColumns:
+    def __init__(self, count, tables, codes, mm=None):
+        self.count = count
+        self.tables = tables    # field: [None, value, ...]
+        self.codes = codes      # field: array or memoryview of codes
+        self.mm = mm            # keeps the mmap open for the codes
+
+    def close(self):
+        if self.mm:
+            for k in self.codes:
+                self.codes[k].release()
+            self.mm.close()
+            self.mm = None
+
+def file_hash(filename):
+    import hashlib
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(read_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def build_qso_cache(adifile, cachefile):
+    import json
+    from array import array
+
+    print("Building column cache",cachefile)
+    values = {k: [] for k in cache_fields}
+    for record in read_adifile(adifile):
+        d = extract_fields(record)
+        if d['CALL']:
+            for k in cache_fields:
+                values[k].append(d[k])
+    count = len(values['CALL'])
+
+    tables = {}
+    codes = {}
+    for k in cache_fields:
+        table = [None] + sorted(set(values[k]) - {None})
+        index = {v: i for i, v in enumerate(table)}
+        tables[k] = table
+        codes[k] = array('I', map(index.__getitem__, values[k]))
+        del values[k]
+
+    # the header holds where each column is, relative to the end of the
+    # header, which is padded so the code arrays stay aligned
+    st = os.stat(adifile)
+    header = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+        'sha256': file_hash(adifile), 'count': count,
+        'byteorder': sys.byteorder, 'itemsize': array('I').itemsize,
+        'fields': {}}
+    blobs = []
+    offset = 0
+    for k in cache_fields:
+        blob = '\0'.join(tables[k][1:]).encode('latin1')
+        blob += b'\0' * (-len(blob) % 8)
+        column = codes[k].tobytes()
+        column += b'\0' * (-len(column) % 8)
+        header['fields'][k] = {'values': len(tables[k]) - 1,
+            'table': [offset, len(blob)],
+            'codes': offset + len(blob)}
+        blobs += [blob, column]
+        offset += len(blob) + len(column)
+    text = json.dumps(header).encode()
+    text += b' ' * (-(len(cache_magic) + 4 + len(text)) % 8)
+
+    tmpfile = cachefile + '.tmp'
+    try:
+        with open(tmpfile,'wb') as f:
+            f.write(cache_magic + len(text).to_bytes(4, 'little') + text)
+            for blob in blobs:
+                f.write(blob)
+        Path(tmpfile).replace(cachefile)
+    except OSError as e:
+        print("Couldn't write column cache:",e)
+    return QSOColumns(count, tables, codes)
+
+# load_qso_cache -- the QSOColumns in cachefile, or None if there isn't
+# one that matches adifile.  A corrupt or truncated cache is None too, so
+# it gets built again.  If adifile has only been touched (same hash, new
+# mtime), the header gets the new mtime so later runs don't hash it again.
+def load_qso_cache(adifile, cachefile):
+    try:
+        return read_qso_cache(adifile, cachefile)
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def read_qso_cache(adifile, cachefile):
+    import json
+    import mmap
+    from array import array
+
+    try:
+        f = open(cachefile,'rb')
+    except OSError:
+        return None
+    with f:
+        if f.read(len(cache_magic)) != cache_magic:
+            return None
+        size = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(size))
+        start = f.tell()
+        st = os.stat(adifile)
+        if header['byteorder'] != sys.byteorder or \
+                header['itemsize'] != array('I').itemsize or \
+                header['size'] != st.st_size:
+            return None
+        if header['mtime_ns'] != st.st_mtime_ns:
+            if header['sha256'] != file_hash(adifile):
+                return None
+            header['mtime_ns'] = st.st_mtime_ns
+            text = json.dumps(header).encode()
+            if len(text) <= size:
+                try:
+                    with open(cachefile,'r+b') as g:
+                        g.seek(len(cache_magic) + 4)
+                        g.write(text + b' ' * (size - len(text)))
+                except OSError:
+                    pass
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    count = header['count']
+    view = memoryview(mm)
+    tables = {}
+    codes = {}
+    for k, col in header['fields'].items():
+        offset, length = col['table']
+        pos = start + col['codes']
+        if start + offset + length > len(mm) or \
+                pos + count * header['itemsize'] > len(mm):
+            raise ValueError('truncated cache')
+        table = [None]
+        if col['values']:
+            table += bytes(view[start+offset:start+offset+length]).rstrip(
+                b'\0').decode('latin1').split('\0')
+        tables[k] = table
+        codes[k] = view[pos:pos+count*header['itemsize']].cast('I')
+    view.release()
+    return QSOColumns(count, tables, codes, mm)
+
+def open_qso_cache(adifile):
+    cachefile = adifile + '.cache'
+    return load_qso_cache(adifile, cachefile) or \
+        build_qso_cache(adifile, cachefile)
+
+# column_filters -- the where_filter conditions that only look at one
+# field, as a test of that field's value, so each distinct value in a
+# column only has to be tried once; and the conditions that look at more
+def column_filters(args):
+    filters = {}
+    others = []
+    for node in where_filter(args).nodes:
+        if len(node.fields) == 1:
+            k, = node.fields
+            test = (lambda t, k: lambda v: t({k: v}))(node.test, k)
+            filters[k] = all_of([filters[k], test]) if k in filters else test
+        else:
+            others.append(node)
+    return filters, others
+
+# select_rows -- the row numbers that pass the filters
+def select_rows(columns, args):
+    from itertools import compress
+    rows = range(columns.count)
+    filters, others = column_filters(args)
+    for k, test in filters.items():
+        ok = bytes(map(test, columns.tables[k]))
+        codes = columns.codes[k]
+        rows = list(compress(rows,
+            map(ok.__getitem__, map(codes.__getitem__, rows))))
+    # the distance tests and the like take two columns or more, tried on
+    # each row that's left (GeoFilter still only tries each (grid, my
+    # grid) pair once)
+    for node in others:
+        fields = sorted(node.fields)
+        values = [list(map(columns.tables[k].__getitem__,
+            map(columns.codes[k].__getitem__, rows))) for k in fields]
+        rows = list(compress(rows, [node.test(dict(zip(fields, v)))
+            for v in zip(*values)]))
+    return list(rows)
+
+# column_qsos -- QSO objects for the given rows.  The values come from
+# the tables, so each distinct string is only held once.
+def column_qsos(columns, rows):
+    values = [list(map(columns.tables[k].__getitem__,
+        map(columns.codes[k].__getitem__, rows))) for k in qso_fields]
+    return list(map(QSO, *values))
+
+###############################################################################
+# sort_fields -- the log is sorted by 'CALL','GRIDSQUARE', 'STATE',
+# 'COUNTRY', 'BAND', or 'MODE' first if --sortby is given, then by date
+# and time
+###############################################################################
+sort_choices = ('CALL','GRIDSQUARE','STATE','COUNTRY','BAND','MODE')
+
+def sort_fields(args):
+    if args.sortby:
+        return (args.sortby, 'QSO_DATE', 'TIME_ON')
+    return ('QSO_DATE', 'TIME_ON')
+
+###############################################################################
+# SortKeys -- sorting by integer codes.  Rather than comparing tuples of
+# strings, each sort field is dictionary-encoded: its distinct values
+# are sorted once and every QSO gets its value's place in that list as
+# an integer code.  QSO date and time become one code the same way.
+# An order is then one integer per QSO (field code times the number of
+# date/times, plus the date/time code), and an argsort on those gives
+# the same order as sorting on (field, QSO_DATE, TIME_ON), ties kept in
+# input order.  The date/time codes are shared by every order.
+###############################################################################
+def dict_codes(values):
+    table = sorted(set(values) - {None})
+    index = {v: i + 1 for i, v in enumerate(table)}
+    index[None] = 0
+    return list(map(index.__getitem__, values)), len(table) + 1
+
+class SortKeys:
+    def __init__(self, qso_list):
+        self.qso_list = qso_list
+        self.datetime, self.num_datetimes = dict_codes(list(zip(
+            map(attrgetter('QSO_DATE'), qso_list),
+            map(attrgetter('TIME_ON'), qso_list))))
+
+    def sorted_by(self, field=None):
+        keys = self.datetime
+        if field:
+            codes = dict_codes(list(map(attrgetter(field),
+                self.qso_list)))[0]
+            n = self.num_datetimes
+            keys = [c * n + d for c, d in zip(codes, keys)]
+        return list(map(self.qso_list.__getitem__,
+            sorted(range(len(keys)), key=keys.__getitem__)))
+
+###############################################################################
+# Multi-process parsing.  With --workers N, split_adifile cuts adifile
+# into byte ranges that each end on an <eor>, and a pool of N processes
+# parses, filters and sorts the ranges (parse_range).  The workers send
+# back plain tuples, which pickle much faster than QSO objects, and the
+# sorted pieces are merged in file order, so ties come out just as they
+# would from one process.  There are 4 ranges per worker so a slow range
+# doesn't hold up the rest.
+###############################################################################
+record_end = re.compile(rb'<eo[rh]>', re.IGNORECASE)
+
+def split_adifile(adifile, num_ranges):
+    import mmap
+    size = os.path.getsize(adifile)
+    if not size:
+        return []
+    bounds = [0]
+    with open(adifile,'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, num_ranges):
+            m = record_end.search(mm, max(bounds[-1], size * i // num_ranges))
+            if not m:
+                break
+            if m.end() > bounds[-1]:
+                bounds.append(m.end())
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+def parse_range(args, adifile, start, end):
+    import mmap
+    rows = []
+    with open(adifile,'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunks = (mm[pos:min(pos + read_size, end)].decode('latin1')
+            for pos in range(start, end, read_size))
+        for d in filter_records(args, read_adif_records(chunks)):
+            rows.append(tuple([d[k] for k in qso_fields]))
+    rows.sort(key=row_key(args))
+    return rows
+
+# row_key -- sort_fields for a tuple of qso_fields.  A missing value
+# (None, e.g. no COUNTRY) sorts first, as it does in SortKeys.
+def row_key(args):
+    indexes = [qso_fields.index(k) for k in sort_fields(args)]
+    def key(row):
+        return tuple([(row[i] is not None, row[i] or '') for i in indexes])
+    return key
+
+def read_qsos_parallel(args, adifile):
+    from concurrent.futures import ProcessPoolExecutor
+    import heapq
+
+    ranges = split_adifile(adifile, args.workers * 4)
+    if not ranges:
+        return []
+    starts, ends = zip(*ranges)
+    with ProcessPoolExecutor(args.workers) as pool:
+        parts = list(pool.map(parse_range, [args] * len(ranges),
+            [adifile] * len(ranges), starts, ends))
+    return [QSO.from_values(row) for row in
+        heapq.merge(*parts, key=row_key(args))]
+
+###############################################################################
+# External sort.  With --max_memory MB, make_logfile doesn't keep the
+# whole log in memory: filtered QSOs are collected as tuples until their
+# estimated size passes the limit, then that run is sorted and spilled to
+# a temporary file.  SortedRuns merges the runs with heapq.merge each
+# time it's iterated, so the log is written (and the reports made) one
+# QSO at a time.  The last run stays in memory, so a log that fits
+# never touches the disk.  So as not to have too many files open at
+# once, more than merge_fan_in spilled runs are first merged, that many
+# at a time, into longer runs.
+###############################################################################
+row_overhead = sys.getsizeof(tuple(qso_fields)) + \
+    len(qso_fields) * sys.getsizeof('')
+merge_fan_in = 100
+
+class SortedRuns:
+    def __init__(self, key):
+        self.key = key
+        self.runs = []
+        self.count = 0
+        self.spilled = 0
+        self.tmpdir = None
+
+    def add_run(self, rows, spill=True):
+        rows.sort(key=self.key)
+        self.count += len(rows)
+        if not spill:
+            self.runs.append(rows)
+            return
+        self.runs.append(self.write_run(rows))
+
+    # write_run -- spill sorted rows to a new run file, returning its name
+    def write_run(self, rows):
+        import pickle
+        import tempfile
+        from itertools import islice
+        if not self.tmpdir:
+            self.tmpdir = tempfile.TemporaryDirectory(prefix='lotw_tool_')
+        runfile = os.path.join(self.tmpdir.name,
+            'run{}'.format(self.spilled))
+        self.spilled += 1
+        rows = iter(rows)
+        with open(runfile,'wb') as f:
+            while True:
+                chunk = list(islice(rows, 1000))
+                if not chunk:
+                    break
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+        return runfile
+
+    # merge_runs -- merge the spilled runs merge_fan_in at a time until
+    # there are no more than merge_fan_in of them
+    def merge_runs(self):
+        import heapq
+        files = [r for r in self.runs if isinstance(r, str)]
+        kept = [r for r in self.runs if not isinstance(r, str)]
+        while len(files) > merge_fan_in:
+            merged = []
+            for i in range(0, len(files), merge_fan_in):
+                group = files[i:i+merge_fan_in]
+                if len(group) == 1:
+                    merged += group
+                    continue
+                merged.append(self.write_run(heapq.merge(
+                    *[self.read_run(r) for r in group], key=self.key)))
+                for r in group:
+                    os.remove(r)
+            files = merged
+        self.runs = files + kept
+
+    @staticmethod
+    def read_run(runfile):
+        import pickle
+        with open(runfile,'rb') as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+
+    def __iter__(self):
+        import heapq
+        runs = [self.read_run(r) if isinstance(r, str) else r
+            for r in self.runs]
+        for row in heapq.merge(*runs, key=self.key):
+            yield QSO(*row)
+
+    def __len__(self):
+        return self.count
+
+def sort_bounded(args, records):
+    limit = args.max_memory * 1024 * 1024
+    sorted_runs = SortedRuns(row_key(args))
+    rows = []
+    size = 0
+    for d in filter_records(args, records):
+        row = tuple([d[k] for k in qso_fields])
+        rows.append(row)
+        size += row_overhead + sum([len(v) for v in row if v])
+        if size > limit:
+            sorted_runs.add_run(rows)
+            rows = []
+            size = 0
+    sorted_runs.add_run(rows, spill=False)
+    if len(sorted_runs.runs) > 1:
+        print("Sorted",len(sorted_runs),"QSOs in",len(sorted_runs.runs),
+            "runs")
+    sorted_runs.merge_runs()
+    return sorted_runs
+
+###############################################################################
+# make_logfile -- process adifile to logfile format.  Returns the sorted
+# list of QSOs that went into the logfile.  records, if given, is where
+# the raw ADIF records come from instead of reading adifile.
+###############################################################################
+def make_logfile(args,adifile,logfile,records=None):
+    qso_list = []   # this will be the list of QSOs logged
+    sorted_by = None
+    sort_keys = None
+
+    # parsing and filtering are one pass.  The database, --workers and
+    # --max_memory sort as they go, so their sort time is in here too.
+    with metrics.stage('make_logfile.parse'):
+        if args.db:
+            # the database does the filtering and sorting
+            sorted_by = query_qsos(open_qso_db(args.db, adifile), args)
+        elif args.cache and records is None and not args.max_memory:
+            columns = open_qso_cache(adifile)
+            metrics.add('records_in', columns.count)
+            qso_list = column_qsos(columns, select_rows(columns, args))
+            columns.close()
+        elif args.workers > 1 and records is None and not args.max_memory:
+            metrics.add('bytes_read', os.path.getsize(adifile))
+            sorted_by = read_qsos_parallel(args, adifile)
+        else:
+            # can't select for some fields in the LoTW request,
+            # so filter for them here as the records stream past
+            if records is None:
+                metrics.add('bytes_read', os.path.getsize(adifile))
+                records = read_adifile(adifile)
+            if args.max_memory:
+                sorted_by = sort_bounded(args, records)
+            else:
+                qso_list = [QSO.from_fields(d)
+                    for d in filter_records(args, records, True)]
+        metrics.add('records_out',
+            len(qso_list if sorted_by is None else sorted_by))
+
+    if sorted_by is None:
+        with metrics.stage('make_logfile.sort'):
+            sort_keys = SortKeys(qso_list)
+            sorted_by = sort_keys.sorted_by(args.sortby)
+            metrics.add('records_in', len(sorted_by))
+            metrics.add('records_out', len(sorted_by))
 
     # write output file
+    with metrics.stage('make_logfile.write'):
+        write_logfile(args,adifile,logfile,sorted_by)
+        metrics.add('records_out', len(sorted_by))
+
+    # the same log in other orders, each from the one set of keys
+    if args.also_sortby:
+        with metrics.stage('make_logfile.also_sortby'):
+            sort_keys = sort_keys or SortKeys(sorted_by)
+            p = Path(report_base(logfile, adifile))
+            for field in args.also_sortby:
+                write_logfile(args,adifile,
+                    str(p.parent.joinpath(p.stem + '_by_' + field.lower() +
+                        p.suffix)),
+                    sort_keys.sorted_by(field),field)
+            metrics.add('records_out', len(sorted_by) * len(args.also_sortby))
+
+    return sorted_by
+
+###############################################################################
+# write_logfile -- write QSOs to logfile, with a header listing the
+# options.  sortby, if given, is shown instead of args.sortby.  A
+# logfile of '-' means standard output (log_stdout, if main has moved
+# sys.stdout out of the way).
+###############################################################################
+log_stdout = None
+
+# report_base -- the name other report files are named after: logfile,
+# or if that's stdout, the adifile with .log on the end
+def report_base(logfile, adifile):
+    if logfile != '-':
+        return logfile
+    p = Path(adifile)
+    return str(p.parent.joinpath(p.stem + ".log"))
+
+def write_logfile(args,adifile,logfile,sorted_by,sortby=None):
     print("Writing processed log file to",logfile)
 
+    # logfile is the logfile created from the adifile
+    if logfile == '-':
+        f = log_stdout or sys.stdout
+    else:
+        f = open(logfile,'w')
+    try:
+        write_log(f,args,adifile,sorted_by,sortby)
+        f.flush()
+    except BrokenPipeError:
+        # whatever we were piped to has stopped reading; point stdout at
+        # /dev/null so Python doesn't complain when it flushes at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), f.fileno())
+    finally:
+        if f is not log_stdout and f is not sys.stdout:
+            f.close()
+            metrics.wrote(logfile)
+
+# write_log -- the log itself, header and QSOs, to an open file
+def write_log(f,args,adifile,sorted_by,sortby=None):
     # create file header showing params
     options = vars(args)
+    if sortby:
+        options = dict(options, sortby=sortby, also_sortby=None)
     optstring = ""
-    for k,v in sorted(vars(args).items()):
-        if v:
+    for k,v in sorted(options.items()):
+        if v and not (k in tuning_defaults and v == tuning_defaults[k]):
             if k == 'password':
                 v = "****"
             if k == 'qrz_password':
@@ -405,43 +2371,28 @@ def make_logfile(args,adifile,logfile):
             current += " " + word
     lines.append(current)
 
-    # logfile is the logfile created from the adifile
-    with open(logfile,'w') as f:
-        string = "# Log file created by lotw_tool.py v" + version + \
-                " from " + adifile + "\n"
-        f.write(string)
-        for l in lines:
-            if len(l) > 1:
-                l = '# ' +l + '\n'
-                f.write(l)
-        string = \
-            "# Fields: Date, Call, Band, Mode, QSL, Grid, State, Country\n"
-        f.write(string)
-
-        for rec in sorted_by:
-            string = format_qso(rec) + '\n'
-            f.write(string)
+    string = "# Log file created by lotw_tool.py v" + version + \
+            " from " + adifile + "\n"
+    f.write(string)
+    for l in lines:
+        if len(l) > 1:
+            l = '# ' +l + '\n'
+            f.write(l)
+    string = \
+        "# Fields: Date, Call, Band, Mode, QSL, Grid, State, Country"
+    if args.distance:
+        string += ", Km, Bearing"
+    f.write(string + "\n")
+
+    write_qsos(f, sorted_by, args.separator, distance=args.distance,
+        center=args.center)
 
 ###############################################################################
-# get_confirmed_grids -- reads logfile writes a sorted,
-# deduped list of confirmed grids
+# get_confirmed_grids -- take the logged QSOs and write a sorted,
+# deduped list of confirmed grids.  Returns the list.
 ###############################################################################
-def get_confirmed_grids(args,logfile):
-    # this list will hold all the grids from the logfile, sorted and deduped
-    log_grids = []
-
-    # get list of confirmed grids from logfile
-    with open(logfile,encoding='latin1') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            fields = line.split(args.separator)  
-            if fields[5][:4] != '----':
-                # add to the list of confirmed grids
-                log_grids.append(fields[5][:4])
-
-    # sort and remove duplicates
-    log_grids = dedupe_list(log_grids)
+def get_confirmed_grids(qso_list,logfile):
+    log_grids = confirmed_grids(qso_list)
 
     p = Path(logfile)
     confirmed_grids_file = str(p.parent.joinpath(p.stem +
@@ -451,75 +2402,451 @@ def get_confirmed_grids(args,logfile):
     print(confirmed_grids_file)
 
     with open(confirmed_grids_file,"w") as f:
-        string = "# List of " + str(len(log_grids)) + \
-                " confirmed grids created by lotw_tool.py\n"
+        write_confirmed_grids(f,log_grids,logfile)
+    metrics.wrote(confirmed_grids_file)
+
+    return log_grids
+
+# confirmed_grids -- all the grids from the QSOs, sorted and deduped
+def confirmed_grids(qso_list):
+    return dedupe_list([q.GRIDSQUARE[:4] for q in qso_list
+        if q.GRIDSQUARE[:4] != '----'])
+
+def write_confirmed_grids(f,log_grids,source):
+    string = "# List of " + str(len(log_grids)) + \
+            " confirmed grids created by lotw_tool.py\n"
+    f.write(string)
+    string = "# v" + version + " from " + source + "\n"
+    f.write(string)
+    for x in log_grids:
+        string = x + '\n'
         f.write(string)
-        string = "# v" + version + " from " + logfile + "\n"
-        f.write(string)
-        for x in log_grids:
-            string = x + '\n'
-            f.write(string)
 
 ###############################################################################
-# get_qrz_grids -- read logfile, extract calls without grid, send list to
-# qrz.com to fetch what they think the grid is
+# Grid statistics.  GridStats makes one pass over the QSOs and keeps,
+# for the whole log and for every band, mode and band/mode pair, which
+# 4-character grids have been worked and which confirmed, as bitmaps
+# over all 32,400 (18 x 18 x 10 x 10) grids, plus the first date each
+# grid was worked and the first date of a QSO with it that is
+# confirmed.  report() turns that into a dict for JSON output with VUCC
+# progress for each VHF+ band and, given the list of the 488 grids the
+# Fred Fish Memorial Award needs, FFMA progress on 6M.  A QSO counts as
+# confirmed when QSL_RCVD is Y.  Unconfirmed QSOs usually have no grid
+# from LoTW; if QRZ.com grids are supplied, those are used for them.
 ###############################################################################
-def get_qrz_grids(args,logfile,outfile):
-
-    # this list will hold all the calls from the logfile, sorted and deduped
-    log_calls = []
-    # this list will hold all the grids from the logfile, sorted and deduped
-    log_grids = []
-
-    # this list will hold the list of calls and grids returned from qrz.com
-    qrz_grids = []
-
-    # get list of ungridded calls from logfile
-    with open(logfile,encoding='latin1') as f:
-        for line in f:
-            if line.startswith('#'):
+num_grids = 18 * 18 * 10 * 10
+
+# VUCC grids needed per band (satellite VUCC isn't tracked, since the
+# LoTW report as read here doesn't carry the propagation mode)
+vucc_needed = {'6M': 100, '2M': 100, '1.25M': 50, '70CM': 50, '33CM': 25,
+    '23CM': 25, '13CM': 10, '9CM': 10, '6CM': 10, '3CM': 10, '1.25CM': 5,
+    '6MM': 5, '4MM': 5, '2.5MM': 5, '2MM': 5, '1MM': 5, 'SUBMM': 5}
+
+class GridIndex(dict):
+    def __missing__(self, grid):
+        g = (grid or '')[:4].upper()
+        i = None
+        if len(g) == 4 and 'A' <= g[0] <= 'R' and 'A' <= g[1] <= 'R' and \
+                '0' <= g[2] <= '9' and '0' <= g[3] <= '9':
+            i = (((ord(g[0]) - 65) * 18 + ord(g[1]) - 65) * 10 +
+                int(g[2])) * 10 + int(g[3])
+        self[grid] = i
+        return i
+
+grid_index = GridIndex()
+
+def grid_name(i):
+    i, d2 = divmod(i, 10)
+    i, d1 = divmod(i, 10)
+    f1, f2 = divmod(i, 18)
+    return chr(65 + f1) + chr(65 + f2) + str(d1) + str(d2)
+
+def bit_count(bitmap):
+    return bin(int.from_bytes(bitmap, 'little')).count('1')
+
+def bitmap_grids(bitmap):
+    return [grid_name(i * 8 + bit) for i, byte in enumerate(bitmap) if byte
+        for bit in range(8) if byte >> bit & 1]
+
+def bitmap_op(op, a, b):
+    return bytearray(op(int.from_bytes(a, 'little'),
+        int.from_bytes(b, 'little')).to_bytes(len(a), 'little'))
+
+class GridScope:
+    __slots__ = ('worked', 'confirmed', 'first')
+
+    def __init__(self):
+        self.worked = bytearray(num_grids // 8 + 1)
+        self.confirmed = bytearray(num_grids // 8 + 1)
+        self.first = {}     # grid index: [first worked, first confirmed]
+
+    def add(self, i, date, confirmed):
+        self.worked[i >> 3] |= 1 << (i & 7)
+        first = self.first.get(i)
+        if first is None:
+            first = self.first[i] = [date, None]
+        elif date < first[0]:
+            first[0] = date
+        if confirmed:
+            self.confirmed[i >> 3] |= 1 << (i & 7)
+            if first[1] is None or date < first[1]:
+                first[1] = date
+
+    def merge(self, other):
+        self.worked = bitmap_op(operator.or_, self.worked, other.worked)
+        self.confirmed = bitmap_op(operator.or_, self.confirmed,
+            other.confirmed)
+        for i, (worked, confirmed) in other.first.items():
+            first = self.first.get(i)
+            if first is None:
+                self.first[i] = [worked, confirmed]
                 continue
-            fields = line.split(args.separator)  
-            if fields[5][:4] == '----':
-                # need to look up this call in qrz
-                log_calls.append(fields[1])
+            first[0] = min(first[0], worked)
+            if confirmed and (first[1] is None or confirmed < first[1]):
+                first[1] = confirmed
+
+    def totals(self):
+        return {'worked': bit_count(self.worked),
+            'confirmed': bit_count(self.confirmed)}
+
+    def has_confirmed(self, i):
+        return self.confirmed[i >> 3] >> (i & 7) & 1
+
+# GridStats only keeps a scope per band/mode pair as it goes; the band,
+# mode and whole-log scopes are merged from those when asked for
+class GridStats:
+    def __init__(self):
+        self.pairs = {}     # (band, mode): GridScope
+
+    def add_qsos(self, qso_list, qrz_grids=None):
+        pairs = self.pairs
+        for q in qso_list:
+            confirmed = q.QSL_RCVD == 'Y'
+            i = grid_index[q.GRIDSQUARE]
+            if i is None and not confirmed and qrz_grids:
+                i = grid_index[qrz_grids.get(q.CALL)]
+            if i is None:
+                continue
+            key = (q.BAND, q.MODE)
+            scope = pairs.get(key)
+            if scope is None:
+                scope = pairs[key] = GridScope()
+            scope.add(i, q.QSO_DATE, confirmed)
+
+    # scopes -- {'all': {'': scope}, 'band': {band: scope}, 'mode': ...,
+    # 'band_mode': {'band/mode': scope}}
+    def scopes(self):
+        scopes = {'all': {'': GridScope()}, 'band': {}, 'mode': {},
+            'band_mode': {}}
+        for (band, mode), pair in sorted(self.pairs.items(),
+                key=lambda x: (str(x[0][0]), str(x[0][1]))):
+            scopes['band_mode']['{}/{}'.format(band, mode)] = pair
+            for kind, name in (('all', ''), ('band', band), ('mode', mode)):
+                if name not in scopes[kind]:
+                    scopes[kind][name] = GridScope()
+                scopes[kind][name].merge(pair)
+        return scopes
+
+    def report(self, ffma_grids=None):
+        scopes = self.scopes()
+        report = {'grids_possible': num_grids}
+        report.update(scopes['all'][''].totals())
+        for kind in ('band', 'mode', 'band_mode'):
+            totals = report[kind + 's'] = {}
+            for name in sorted(scopes[kind], key=str):
+                scope = scopes[kind][name]
+                totals[name] = scope.totals()
+                if kind == 'band' and name and name.upper() in vucc_needed:
+                    needed = vucc_needed[name.upper()]
+                    have = totals[name]['confirmed']
+                    totals[name]['vucc'] = {'needed': needed,
+                        'qualified': have >= needed,
+                        'to_go': max(0, needed - have)}
+                    totals[name]['worked_not_confirmed'] = bitmap_grids(
+                        bitmap_op(lambda w, c: w & ~c, scope.worked,
+                            scope.confirmed))
+
+        grids = report['grids'] = {}
+        first = scopes['all'][''].first
+        for i, (worked, confirmed) in sorted(first.items()):
+            grids[grid_name(i)] = {'first_worked': adif_date(worked),
+                'first_confirmed': confirmed and adif_date(confirmed),
+                'bands': {}}
+        for band, scope in scopes['band'].items():
+            for i, (worked, confirmed) in scope.first.items():
+                grids[grid_name(i)]['bands'][band] = [adif_date(worked),
+                    confirmed and adif_date(confirmed)]
+
+        if ffma_grids is not None:
+            scope = scopes['band'].get('6M', GridScope())
+            wanted = {grid_index[g] for g in ffma_grids} - {None}
+            have = {i for i in wanted if scope.has_confirmed(i)}
+            report['ffma'] = {'needed': len(wanted),
+                'confirmed': len(have),
+                'missing': sorted(grid_name(i) for i in wanted - have)}
+        return report
+
+# read_grid_list -- grids from a text file, separated by spaces, commas
+# or new lines; '#' starts a comment
+def read_grid_list(filename):
+    grids = []
+    with open(filename) as f:
+        for line in f:
+            grids += line.split('#')[0].replace(',', ' ').split()
+    return grids
 
-    # sort and remove duplicates
-    log_calls = dedupe_list(log_calls)
+# write_grid_stats -- run GridStats over the QSOs and write the report
+# as JSON next to the log.  Returns the report.
+def write_grid_stats(args,qso_list,logfile,qrz_grids=None):
+    import json
 
-    print("Querying QRZ.com for",len(log_calls),"calls.",end=" ")
+    report = grid_stats_report(args,qso_list,logfile,qrz_grids)
+
+    p = Path(logfile)
+    stats_file = str(p.parent.joinpath(p.stem + "_grid_stats.json"))
+    print("Writing grid statistics ({} worked, {} confirmed) to".format(
+        report['worked'], report['confirmed']), stats_file)
+    with open(stats_file,'w') as f:
+        json.dump(report, f, indent=1)
+    metrics.wrote(stats_file)
+    return report
+
+def grid_stats_report(args,qso_list,logfile,qrz_grids=None):
+    stats = GridStats()
+    stats.add_qsos(qso_list, qrz_grids and
+        {call: grid for grid, call in qrz_grids})
+    ffma_grids = read_grid_list(args.ffma_grids) if args.ffma_grids else None
+    report = stats.report(ffma_grids)
+    report['created_by'] = 'lotw_tool.py v' + version
+    report['log'] = logfile
+    return report
 
-    # login to QRZ.com and get session key
-    qrz_https_url = "https://xmldata.qrz.com/xml/current/"
-    qrz_http_url = "http://xmldata.qrz.com/xml/current/"
+###############################################################################
+# QRZ.com XML interface.  We log in once to get a session key, then look
+# up each call with that key.
+###############################################################################
+qrz_https_url = "https://xmldata.qrz.com/xml/current/"
+qrz_http_url = "http://xmldata.qrz.com/xml/current/"
+
+# qrz_value -- poor man's xml parser; return the text of the first
+# <tag>, or None
+def qrz_value(text, tag):
+    m = re.search('<' + tag + r'>\s*(\S*?)\s*</' + tag + '>', text)
+    return m.group(1) if m else None
+
+# qrz_error -- the text of the reply's <Error>, or None
+def qrz_error(text):
+    m = re.search(r'<Error>(.*?)</Error>', text, re.DOTALL)
+    return m.group(1).strip() if m else None
+
+# qrz_login -- the session key.  A login QRZ.com turns down ends the run,
+# rather than every lookup failing and being taken as "no grid".
+def qrz_login(session, args):
     agent = "lotw_tool_v" + version
     data = { 'username':args.qrz_login,'password':args.qrz_password,
             'agent':agent }
-    r = http_get_request(qrz_https_url,data,ssl=True)
-    key = ""
-    fields = r.split()
-    for rec in fields:
-        # poor man's xml parser
-        if '<Key>' in rec:
-            key = rec.replace('>','<').split('<')[2]
-
-    # now fetch grid from QRZ.com using session key for each call
-    qrz_list = []
-    start_time = time.time()
-    for call in log_calls:
-        data = { 's':key,'callsign':call }
-        r = http_get_request(qrz_http_url,data,ssl=False)
-        fields = r.split()
+    r = http_get_request(qrz_https_url,data,session)
+    key = qrz_value(r, 'Key')
+    if qrz_error(r) or not key:
+        exit('QRZ.com login failed: ' + (qrz_error(r) or 'no session key'))
+    return key
+
+# qrz_lookup -- the call's grid.  If qrz doesn't know the call or its
+# grid, it comes back as '----'.  Any other error (a bad or expired
+# session, too many lookups) raises QRZLookupError, so it isn't taken
+# (and cached) as an answer.
+class QRZLookupError(Exception):
+    pass
+
+def qrz_lookup(session, key, call):
+    data = { 's':key,'callsign':call }
+    r = http_get_request(qrz_http_url,data,session)
+    error = qrz_error(r)
+    if error and not error.lower().startswith('not found'):
+        raise QRZLookupError(error)
+    return qrz_value(r, 'grid') or "----"
 
-        # if qrz doesn't know the grid, it stays as '----'
-        grid = "----"
-        for rec in fields:
-            # poor man's xml parser
-            if '<grid>' in rec:
-                grid = rec.replace('>','<').split('<')[2]
+###############################################################################
+# QRZCache -- SQLite cache of QRZ.com lookups, keyed by call.  Each entry
+# has the grid (NULL if QRZ.com didn't know it), when it was fetched and
+# when it was last used.  Entries older than ttl_days are treated as
+# missing, and once there are more than max_entries the least recently
+# used ones are dropped.  One cache can be shared between threads.
+###############################################################################
+class QRZCache:
+    def __init__(self, filename, ttl_days=30, max_entries=100000):
+        import sqlite3
+        path = Path(filename).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS qrz (call TEXT PRIMARY '\
+            'KEY, grid TEXT, fetched REAL, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS qrz_used ON qrz (used)')
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+
+    # get -- return {call: grid} for the calls with a fresh entry
+    def get(self, calls):
+        now = time.time()
+        found = {}
+        calls = list(calls)
+        with self.lock:
+            for i in range(0, len(calls), 500):
+                batch = calls[i:i+500]
+                rows = self.db.execute('SELECT call, grid FROM qrz WHERE '\
+                    'fetched > ? AND call IN (' + ','.join('?' * len(batch)) +
+                    ')', [now - self.ttl] + batch)
+                for call, grid in rows:
+                    found[call] = grid or '----'
+            self.db.executemany('UPDATE qrz SET used = ? WHERE call = ?',
+                [(now, call) for call in found])
+            self.db.commit()
+        return found
+
+    # put -- store [grid, call] pairs; a '----' grid means "not found"
+    def put(self, results):
+        now = time.time()
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO qrz VALUES '\
+                '(?,?,?,?)', [(call, None if grid == '----' else grid, now,
+                now) for grid, call in results])
+            self.db.commit()
+
+    def evict(self):
+        with self.lock:
+            self.db.execute('DELETE FROM qrz WHERE call IN (SELECT call '\
+                'FROM qrz ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+            self.db.commit()
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+def open_qrz_cache(args):
+    if not args.qrz_cache or args.qrz_cache.lower() == 'none':
+        return None
+    return QRZCache(args.qrz_cache, args.qrz_cache_days, args.qrz_cache_size)
+
+###############################################################################
+# QRZLookups -- the QRZ.com session, login, rate limiter, thread pool and
+# cache that lookups go through.  Each lookup_qrz_grids call normally
+# makes its own, but a --batch run shares one (qrz_lookups) between all
+# its accounts.  Lookups are kept as futures by call, so a call that
+# several accounts need is only looked up once, even if they all ask at
+# the same time.  Nothing logs in until a call has to be looked up.
+###############################################################################
+qrz_lookups = None
+
+class QRZLookups:
+    def __init__(self, args):
+        self.args = args
+        self.cache = open_qrz_cache(args)
+        self.lock = threading.Lock()
+        self.futures = {}       # call: future of [grid, call]
+        self.pool = None
+
+    # lookup -- futures of [grid, call] for calls, in order
+    def lookup(self, calls):
+        from concurrent.futures import ThreadPoolExecutor
+        with self.lock:
+            if self.pool is None:
+                args = self.args
+                self.session = make_session(args.qrz_workers)
+                self.key = qrz_login(self.session, args)
+                self.limiter = RateLimiter(args.qrz_rate)
+                self.pool = ThreadPoolExecutor(max_workers=args.qrz_workers)
+            for call in calls:
+                if call not in self.futures:
+                    self.futures[call] = self.pool.submit(
+                        metrics.bind(self.lookup_one), call)
+            return [self.futures[call] for call in calls]
+
+    # lookup_one -- [grid, call].  Sessions expire, so after an error
+    # log in again (just once, whichever thread gets there first) and
+    # retry; a second error ends the run.
+    def lookup_one(self, call):
+        self.limiter.wait()
+        key = self.key
+        try:
+            return [qrz_lookup(self.session, key, call)[:4], call]
+        except QRZLookupError:
+            with self.lock:
+                if self.key == key:
+                    self.key = qrz_login(self.session, self.args)
+        self.limiter.wait()
+        try:
+            return [qrz_lookup(self.session, self.key, call)[:4], call]
+        except QRZLookupError as e:
+            exit('QRZ.com lookup of {} failed: {}'.format(call, e))
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.session.close()
+        if self.cache:
+            self.cache.close()
+
+###############################################################################
+# lookup_qrz_grids -- look up a list of calls on QRZ.com, args.qrz_workers
+# at a time over one shared session, and no faster than args.qrz_rate
+# lookups per second.  Calls with a fresh entry in the QRZ cache aren't
+# looked up at all unless args.refresh_qrz is set.  Returns [grid, call]
+# pairs in the order of calls.
+###############################################################################
+def lookup_qrz_grids(args, calls):
+    from concurrent.futures import as_completed
+    lookups = qrz_lookups or QRZLookups(args)
+    cache = lookups.cache
+    grids = {}
+    if cache and not args.refresh_qrz:
+        grids = cache.get(calls)
+        print("(" + str(len(grids)), "from cache)", end=" ", flush=True)
+    misses = [call for call in calls if call not in grids]
+
+    failed = None
+    if misses:
+        try:
+            futures = lookups.lookup(misses)
+        except (SystemExit, Exception) as e:
+            # the login failed; close up before passing it on
+            failed, futures = e, []
+        for f in as_completed(futures):
+            print('.',end='',flush=True)
+
+        # cache the answers we got even if some lookups failed
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result())
+            except (SystemExit, Exception) as e:
+                failed = e
+        if cache:
+            cache.put(results)
+        for grid, call in results:
+            grids[call] = grid
+
+    if lookups is not qrz_lookups:
+        lookups.close()
+    if failed:
+        raise failed
+    return [[grids[call], call] for call in calls]
 
-        qrz_list.append([grid[:4],call])
-        print('.',end='',flush=True)
+###############################################################################
+# get_qrz_grids -- take the logged QSOs, extract calls without grid, send
+# list to qrz.com to fetch what they think the grid is.  Writes the
+# results to outfile and returns them as a sorted list of [grid, call].
+###############################################################################
+def get_qrz_grids(args,qso_list,outfile):
+
+    # this list will hold all the ungridded calls, sorted and deduped
+    log_calls = dedupe_list([q.CALL for q in qso_list
+        if q.GRIDSQUARE[:4] == '----'])
+
+    print("Querying QRZ.com for",len(log_calls),"calls.",end=" ")
+    start_time = time.time()
+    qrz_list = lookup_qrz_grids(args, log_calls)
 
     qrz_list = sorted(qrz_list)
     num  = len(qrz_list)
@@ -533,19 +2860,49 @@ def get_qrz_grids(args,logfile,outfile):
         for l in qrz_list:
             string = l[0] + '\t' + l[1] + '\n'
             f.write(string)
+    metrics.wrote(outfile)
     print()
     print("Finished getting QRZ.com matches for", num, "calls in", \
     "{:.0f}".format(time.time() - start_time))
     print("seconds, and wrote data to",outfile)
+    return qrz_list
+
+##############################################################################
+# index_calls -- one pass over the QSO list to build a dict of call ->
+# list of QSOs with that call, and the set of calls that have a grid in
+# at least one QSO.  The reports look calls up in these rather than
+# scanning the whole QSO list for each one.
+##############################################################################
+def index_calls(qso_list):
+    by_call = {}
+    with_grid = set()
+    for q in qso_list:
+        by_call.setdefault(q.CALL, []).append(q)
+        if q.GRIDSQUARE[:4] != '----':
+            with_grid.add(q.CALL)
+    return by_call, with_grid
 
 ##############################################################################
 # get_gridless -- create list of calls/qsos for which we haven't
-# been able to find a grid
+# been able to find a grid.  Returns the QSOs.
 ##############################################################################
-def get_gridless(logfile,qso_list,qrz_grids):
+def get_gridless(logfile,qrzfile,qso_list,qrz_grids,sep):
     # this file will hold the QSOs for which we still don't have a grid
     p = Path(logfile)
     gridless_file = str(p.parent.joinpath(p.stem + '_gridless.txt'))
+    gridless, gridless_qsos = find_gridless(qso_list,qrz_grids)
+
+    with open(gridless_file,'w') as f:
+        write_gridless(f,gridless_qsos,qrzfile,sep)
+    metrics.wrote(gridless_file)
+
+    print("Wrote {} QSOs ({} unique calls) with no grid\n\tto {}...".format(
+        len(gridless_qsos),len(gridless),gridless_file))
+    return gridless_qsos
+
+# find_gridless -- the calls QRZ.com had no grid for either, and their
+# QSOs without a grid
+def find_gridless(qso_list,qrz_grids):
     gridless = []   # list of calls with no matching grid
     gridless_qsos = []  # list of qsos with those calls
 
@@ -554,199 +2911,610 @@ def get_gridless(logfile,qso_list,qrz_grids):
             gridless.append(x[1])
     gridless = dedupe_list(gridless)
 
+    by_call, with_grid = index_calls(qso_list)
     for x in gridless:
-        for y in qso_list:
-            if x.strip() in y and y[5][:4] == '----':
-                gridless_qsos.append(y)    
+        for y in by_call.get(x.strip(), []):
+            if y.GRIDSQUARE[:4] == '----':
+                gridless_qsos.append(y)
 
     # sort by call, then date
-    gridless_qsos.sort(key=lambda x: (x[1],x[0]))
-
-    with open(gridless_file,'w') as f:
-        string = "# " + str(len(gridless_qsos)) + \
-                " QSOs whose grids cannot be found, created by lotw_tool.py\n"
-        f.write(string)
-        string = "# v" + version + " from " + qrzfile + "\n"
-        f.write(string)
-        string = "#\n"
-        f.write(string)
-        string = "# Rovers:\n"
-        f.write(string)
-        for x in gridless_qsos:
-            if '/R' in x[1]:
-                string = "{}{}{}{}{}{}{}{}{}{}{}{}{}{}\n".format(
-                    x[0],sep,x[1],sep,x[2],sep,x[3],sep,x[4],
-                    sep,x[5],sep,x[6],sep,x[7])
-                f.write(string)
-        string = "#\n"
-        f.write(string)
-        string = "# Others:\n"
-        f.write(string)
-        for x in gridless_qsos:
-            if '/R' not in x[1]:
-                string = "{}{}{}{}{}{}{}{}{}{}{}{}{}{}\n".format(
-                    x[0],sep,x[1],sep,x[2],sep,x[3],sep,x[4],
-                    sep,x[5],sep,x[6],sep,x[7])
-                f.write(string)
-
-    print("Wrote {} QSOs ({} unique calls) with no grid\n\tto {}...".format(
-        len(gridless_qsos),len(gridless),gridless_file))
+    gridless_qsos.sort(key=attrgetter('CALL','QSO_DATE','TIME_ON'))
+    return gridless, gridless_qsos
+
+def write_gridless(f,gridless_qsos,source,sep):
+    string = "# " + str(len(gridless_qsos)) + \
+            " QSOs whose grids cannot be found, created by lotw_tool.py\n"
+    f.write(string)
+    string = "# v" + version + " from " + source + "\n"
+    f.write(string)
+    string = "#\n"
+    f.write(string)
+    string = "# Rovers:\n"
+    f.write(string)
+    write_qsos(f, [x for x in gridless_qsos if '/R' in x.CALL], sep)
+    string = "#\n"
+    f.write(string)
+    string = "# Others:\n"
+    f.write(string)
+    write_qsos(f, [x for x in gridless_qsos if '/R' not in x.CALL], sep)
 
 ##############################################################################
 # get_unconfirmed_grids -- build list of grids/qsos that we think we
-# have worked that we think might be unconfirmed
+# have worked that we think might be unconfirmed.  Returns the QSOs, each
+# a copy with the QRZ.com grid in angle brackets.
 ##############################################################################
-def get_unconfirmed_grids(logfile,qso_list,confirmed_grid_list,qrz):
+def get_unconfirmed_grids(logfile,qrzfile,qso_list,confirmed_grid_list,qrz,
+        sep):
     # this file will hold calls and qrz grids for possibly unconfirmed grids
     p = Path(logfile)
     unconfirmed_file = str(p.parent.joinpath(p.stem + '_unconfirmed.txt'))
     new_grid_file = str(p.parent.joinpath(p.stem + '_new_grid_list.txt'))
 
+    qrz, new_grids, unconfirmed_qsos, unconfirmed_calls = \
+        find_unconfirmed(qso_list,confirmed_grid_list,qrz)
+
+    # write list of possibly new grids to file
+    with open(new_grid_file,'w') as f:
+        write_new_grids(f,qrz,new_grids,qrzfile)
+    metrics.wrote(new_grid_file)
+    print("Wrote list of",len(new_grids),"possibly confirmed grids")
+    print("\tto", new_grid_file)
+
+    with open(unconfirmed_file,'w') as f:
+        write_unconfirmed(f,unconfirmed_qsos,new_grids,qrzfile,sep)
+    metrics.wrote(unconfirmed_file)
+
+    print(("Wrote {} QSOs ({} unconfirmed calls) " + \
+            "with {} unconfirmed grids").format(
+            len(unconfirmed_qsos),len(unconfirmed_calls),len(new_grids)))
+    print("\tto",unconfirmed_file)
+    return unconfirmed_qsos
+
+# find_unconfirmed -- the QRZ.com matches that might be new grids, the
+# grids, the QSOs with those calls and the calls.
+def find_unconfirmed(qso_list,confirmed_grid_list,qrz):
     # remove calls from qrz_grids where we still don't have a grid
-    qrz[:] = [x for x in qrz if x[0][:4] != '----']
+    qrz = [x for x in qrz if x[0][:4] != '----']
     # remove calls with a grid we've already confirmed
-    qrz[:] = [x for x in qrz if x[0][:4] not in confirmed_grid_list]
+    confirmed = set(confirmed_grid_list)
+    qrz = [x for x in qrz if x[0][:4] not in confirmed]
 
     # we might have worked this station another time and gotten
     # a grid then.  Exclude that call, at the slight risk
     # they might have moved to another grid.
-    def check_qso_list(call,qso_list):
-        q_with_grid = False
-        for x in qso_list:
-            if x[1] == call and x[5][:4] != '----':
-                q_with_grid = True
-        return q_with_grid       
-
-    qrz[:] = [x for x in qrz if not check_qso_list(x[1],qso_list)]
+    by_call, with_grid = index_calls(qso_list)
+    qrz = [x for x in qrz if x[1] not in with_grid]
 
-    # generate and write list of possibly new grids to file
+    # generate list of possibly new grids
     new_grids = []
     for x in qrz:
         new_grids.append(x[0][:4])
     new_grids.sort()
     new_grids = dedupe_list(new_grids)
-    with open(new_grid_file,'w') as f:
-        string = "# These " + str(len(qrz_grids)) + \
-            " grids might be new; created by lotw_tool.py\n"
-        f.write(string)
-        string = "# v" + version + " from " + qrzfile + "\n"
-        f.write(string)
-        for x in new_grids:
-            string = x + '\n'
-            f.write(string)
-    print("Wrote list of",len(new_grids),"possibly confirmed grids")
-    print("\tto", new_grid_file)
 
     # create the qso list
     unconfirmed_qsos = []
     for x in qrz:
-        for y in qso_list:
-            if y[1] == x[1]:
-                # replace the '----' with putative grid in angle brackets
-                y[5] = '<' + x[0] + '>'
-                unconfirmed_qsos.append(y)    
+        for y in by_call.get(x[1], []):
+            # replace the '----' with putative grid in angle brackets
+            y = y.copy()
+            y.GRIDSQUARE = '<' + x[0] + '>'
+            unconfirmed_qsos.append(y)
     # sort by grid, call, date
-    unconfirmed_qsos.sort(key=lambda x: (x[5],x[1],x[0]))
+    unconfirmed_qsos.sort(key=attrgetter('GRIDSQUARE','CALL','QSO_DATE',
+        'TIME_ON'))
 
     # this list is just to know how many calls represent possibly unconfirmed
     unconfirmed_calls = []
     for x in unconfirmed_qsos:
-        if x[1]:
-            unconfirmed_calls.append(x[1])
+        if x.CALL:
+            unconfirmed_calls.append(x.CALL)
     unconfirmed_calls.sort()
     unconfirmed_calls = dedupe_list(unconfirmed_calls)
-
-    with open(unconfirmed_file,'w') as f:
-        string = "# " + str(len(unconfirmed_qsos)) + \
-            " QSOs that might represent " + str(len(new_grids)).strip() + \
-            " new grids, created by lotw_tool.py\n"
-        f.write(string)
-        string = "# v" + version + " from " + qrzfile + "\n"
-        f.write(string)
-        string = "# Grid fields are from QRZ.com data\n"
+    return qrz, new_grids, unconfirmed_qsos, unconfirmed_calls
+
+def write_new_grids(f,qrz,new_grids,source):
+    string = "# These " + str(len(qrz)) + \
+        " grids might be new; created by lotw_tool.py\n"
+    f.write(string)
+    string = "# v" + version + " from " + source + "\n"
+    f.write(string)
+    for x in new_grids:
+        string = x + '\n'
         f.write(string)
-        for x in unconfirmed_qsos:
-            string = "{}{}{}{}{}{}{}{}{}{}{}{}{}{}\n".format(
-                    x[0],sep,x[1],sep,x[2],sep,x[3],sep,x[4],
-                    sep,x[5],sep,x[6],sep,x[7])
-            f.write(string)
 
-    print(("Wrote {} QSOs ({} unconfirmed calls) " + \
-            "with {} unconfirmed grids").format(
-            len(unconfirmed_qsos),len(unconfirmed_calls),len(new_grids)))
-    print("\tto",unconfirmed_file)
-    print()
-    print("All finished!")
+def write_unconfirmed(f,unconfirmed_qsos,new_grids,source,sep):
+    string = "# " + str(len(unconfirmed_qsos)) + \
+        " QSOs that might represent " + str(len(new_grids)).strip() + \
+        " new grids, created by lotw_tool.py\n"
+    f.write(string)
+    string = "# v" + version + " from " + source + "\n"
+    f.write(string)
+    string = "# Grid fields are from QRZ.com data\n"
+    f.write(string)
+    write_qsos(f, unconfirmed_qsos, sep)
 
 ###############################################################################
+# process_log -- run the processing stages on an ADI file.  The QSOs are
+# parsed once and handed from stage to stage in memory; the text files
+# are outputs only and nothing reads them back.  Returns a dict of what
+# each stage produced: 'logfile' and 'qsos' always, and with
+# --match_missing_grids also 'qrz_grids', 'confirmed_grids', 'gridless'
+# and 'unconfirmed'.  records is passed on to make_logfile.
 ###############################################################################
-# PROGRAM BEGINS
+def process_log(args,adifile,logfile=None,records=None):
+    p = Path(adifile)
+    if not logfile:
+        logfile = str(p.parent.joinpath(p.stem + ".log"))
+    results = {'logfile': logfile}
+    qso_list = make_logfile(args,adifile,logfile,records)
+    results['qsos'] = qso_list
+
+    if args.match_missing_grids:
+        # this file will hold the grid/call results from the qrz queries
+        qrzfile = str(p.parent.joinpath(p.stem + '_qrz_matches.txt'))
+        base = report_base(logfile, adifile)
+        with metrics.stage('get_qrz_grids'):
+            qrz_grids = get_qrz_grids(args,qso_list,qrzfile)
+            metrics.add('records_out', len(qrz_grids))
+        with metrics.stage('get_confirmed_grids'):
+            confirmed_grids = get_confirmed_grids(qso_list,base)
+            metrics.add('records_in', len(qso_list))
+            metrics.add('records_out', len(confirmed_grids))
+        results['qrz_grids'] = qrz_grids
+        results['confirmed_grids'] = confirmed_grids
+        with metrics.stage('get_gridless'):
+            results['gridless'] = get_gridless(base,qrzfile,qso_list,
+                qrz_grids,args.separator)
+            metrics.add('records_out', len(results['gridless']))
+        with metrics.stage('get_unconfirmed_grids'):
+            results['unconfirmed'] = get_unconfirmed_grids(base,qrzfile,
+                qso_list,confirmed_grids,qrz_grids,args.separator)
+            metrics.add('records_out', len(results['unconfirmed']))
+    if args.grid_stats:
+        with metrics.stage('write_grid_stats'):
+            results['grid_stats'] = write_grid_stats(args,qso_list,
+                report_base(logfile, adifile),results.get('qrz_grids'))
+            metrics.add('records_in', len(qso_list))
+    return results
+
 ###############################################################################
+# Serving.  With --serve PORT, lotw_tool.py loads adifile once and answers
+# HTTP GETs on localhost from memory, so a dashboard polling the reports
+# doesn't pay for starting Python and parsing the log every time:
+#     /log           the log, as make_logfile writes it
+#     /confirmed     the confirmed grid list
+#     /gridless      QSOs with no grid from LoTW or QRZ.com
+#     /unconfirmed   QSOs that might be new grids
+#     /new_grids     the grids they might be
+#     /grid_stats    the --grid_stats report (JSON)
+#     /status        what's loaded (JSON)
+# (the QRZ.com reports only if the server has --match_missing_grids).
+# Query parameters set the selection and sort options for one request,
+# named as on the command line, e.g. /log?sortby=CALL&noqsl&where=BAND=6M;
+# anything not given is as the server was started.
+#
+# Each request first stats adifile, and if it has changed the file is
+# read again.  Records are remembered by a digest of their text, so only
+# ones that weren't there before are parsed: appending to the file, or
+# a --sync merge rewriting it, costs about a read of the file and a
+# parse of the new records.  QRZ.com is only asked about new gridless
+# calls.  Answers are kept until the log changes, so a repeated poll is
+# a dict lookup.  Requests are answered one at a time.
 ###############################################################################
+# query_flag etc. -- query parameter values to option values, the same
+# as getargs would give
+def query_flag(v):
+    return v.lower() in ('', '1', 'y', 'yes', 't', 'true')
+
+def query_grid(v):
+    if not grid_box(v.upper()):
+        raise ValueError(v + " isn't a grid locator")
+    return v.upper()
+
+def query_bbox(v):
+    bbox = [float(x) for x in v.replace(',', ' ').split()]
+    if len(bbox) != 4:
+        raise ValueError("bbox needs LAT1,LON1,LAT2,LON2")
+    return bbox
+
+def query_sortby(v):
+    if v.upper() not in sort_choices:
+        raise ValueError("sortby is one of " + ', '.join(sort_choices))
+    return v.upper()
+
+# serve_options -- the query parameters, each with what turns it into
+# the option's value
+serve_options = {
+    'where': str,
+    'mygrid': str.upper,
+    'dx_only': lambda v: 'yes' if query_flag(v) else 'no',
+    'grid': lambda v: '----' if v.upper() == 'NONE' else v.upper(),
+    'noqsl': lambda v: 'yes' if query_flag(v) else 'no',
+    'within': float,
+    'center': query_grid,
+    'bbox': query_bbox,
+    'neighbors': query_grid,
+    'sortby': query_sortby,
+    'distance': query_flag,
+    'separator': str,
+    }
+serve_reports = ('/log','/confirmed','/gridless','/unconfirmed',
+    '/new_grids','/grid_stats')
+
+# ServedLog -- the QSOs from adifile and what's been worked out from them
+class ServedLog:
+    def __init__(self, args, adifile):
+        self.args = args
+        self.adifile = adifile
+        self.lock = threading.Lock()
+        self.stat = None        # (size, mtime) of adifile when read
+        self.qsos = []          # in file order
+        self.digests = {}       # record digest: its QSO (None if no call)
+        self.qrz = {}           # call: QRZ.com grid
+        self.sorted = {}        # sortby: all the QSOs sorted that way
+        self.answers = {}       # (path, query): (content type, body)
+        self.loads = 0
+        self.loaded = None
+        self.requests = 0
+
+    # refresh -- read adifile again if it's changed since last time
+    def refresh(self):
+        from hashlib import blake2b
+        st = os.stat(self.adifile)
+        if (st.st_size, st.st_mtime_ns) == self.stat:
+            return
+        start = time.perf_counter()
+        with open(self.adifile,'rb') as f:
+            data = f.read()
+        qsos = []
+        digests = {}
+        parsed = 0
+        # up to the last <eor>, so a record still being written waits
+        # for the next read
+        pos = 0
+        for m in record_end.finditer(data):
+            record = data[pos:m.start()]
+            pos = m.end()
+            key = blake2b(record, digest_size=16).digest()
+            if key in digests:
+                q = digests[key]
+            elif key in self.digests:
+                q = digests[key] = self.digests[key]
+            else:
+                parsed += 1
+                d = extract_fields(record.decode('latin1'))
+                q = digests[key] = QSO.from_fields(d) if d['CALL'] else None
+            if q is not None:
+                qsos.append(q)
+        # QRZ.com first: if it fails, the request gets a 502 and the old
+        # log is kept, to be read again on the next one
+        if self.args.match_missing_grids:
+            calls = dedupe_list([q.CALL for q in qsos
+                if q.GRIDSQUARE[:4] == '----' and q.CALL not in self.qrz])
+            if calls:
+                print("Querying QRZ.com for",len(calls),"calls.",end=" ")
+                try:
+                    grids = lookup_qrz_grids(self.args, calls)
+                except SystemExit as e:
+                    print()
+                    raise QRZLookupError(str(e.code))
+                except Exception as e:
+                    # not str(e): a requests error quotes the URL, and
+                    # the login URL has the password in it
+                    print()
+                    raise QRZLookupError('QRZ.com lookup failed: ' +
+                        type(e).__name__)
+                for grid, call in grids:
+                    self.qrz[call] = grid
+                print()
+        self.qsos = qsos
+        self.digests = digests
+        self.stat = (st.st_size, st.st_mtime_ns)
+        self.sorted = {}
+        self.answers = {}
+        self.loads += 1
+        self.loaded = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'records': len(digests), 'parsed': parsed, 'qsos': len(qsos),
+            'seconds': round(time.perf_counter() - start, 4)}
+        print("Loaded {} QSOs from {} ({} records parsed) in {:.2f} "
+            "seconds".format(len(qsos), self.adifile, parsed,
+            self.loaded['seconds']))
+
+    # answer -- (content type, body) for a GET of path?query
+    def answer(self, path, query):
+        from urllib.parse import parse_qsl
+        params = tuple(sorted(parse_qsl(query, keep_blank_values=True)))
+        with self.lock:
+            self.requests += 1
+            self.refresh()
+            if path == '/status':
+                return 'application/json', self.status()
+            if path not in serve_reports:
+                raise KeyError(path)
+            key = (path, params)
+            if key not in self.answers:
+                # a dashboard asks the same few things; anything else
+                # shouldn't make the answers grow without end
+                if len(self.answers) >= 1000:
+                    self.answers = {}
+                self.answers[key] = self.report(path, params)
+            return self.answers[key]
+
+    # query_args -- args with the request's options in place of the
+    # server's, and the Where node for them.  Raises ValueError for a
+    # bad one.
+    def query_args(self, params):
+        args = argparse.Namespace(**vars(self.args))
+        for k, v in params:
+            if k not in serve_options:
+                raise ValueError("unknown option " + k + "; use " +
+                    ', '.join(serve_options))
+            setattr(args, k, serve_options[k](v))
+        where = where_filter(args, memo=False)
+        if not where.fields <= set(qso_fields):
+            raise ValueError("the server doesn't keep " +
+                ', '.join(sorted(where.fields - set(qso_fields))) +
+                "; where can only use " + ', '.join(qso_fields))
+        return args, where
+
+    def report(self, path, params):
+        import io
+        import json
+        args, where = self.query_args(params)
+        test = where.test
+        # sorting the whole log once per order and then picking out the
+        # QSOs gives the same list as picking and then sorting
+        if args.sortby not in self.sorted:
+            self.sorted[args.sortby] = \
+                SortKeys(self.qsos).sorted_by(args.sortby)
+        qso_list = [q for q in self.sorted[args.sortby] if test(q)]
+        if path == '/log':
+            f = io.StringIO()
+            write_log(f,args,self.adifile,qso_list)
+            return 'text/plain', f.getvalue()
+        if path == '/confirmed':
+            f = io.StringIO()
+            write_confirmed_grids(f,confirmed_grids(qso_list),self.adifile)
+            return 'text/plain', f.getvalue()
+        qrz_grids = None
+        if self.args.match_missing_grids:
+            qrz_grids = [[self.qrz[call], call] for call in
+                dedupe_list([q.CALL for q in qso_list
+                    if q.GRIDSQUARE[:4] == '----'])]
+        if path == '/grid_stats':
+            return 'application/json', json.dumps(grid_stats_report(args,
+                qso_list,self.adifile,qrz_grids), indent=1)
+        if qrz_grids is None:
+            raise ValueError(path[1:] + " needs the server started with "
+                "--match_missing_grids")
+        f = io.StringIO()
+        if path == '/gridless':
+            gridless, gridless_qsos = find_gridless(qso_list,qrz_grids)
+            write_gridless(f,gridless_qsos,self.adifile,args.separator)
+        else:
+            qrz, new_grids, unconfirmed_qsos, unconfirmed_calls = \
+                find_unconfirmed(qso_list,confirmed_grids(qso_list),
+                    qrz_grids)
+            if path == '/new_grids':
+                write_new_grids(f,qrz,new_grids,self.adifile)
+            else:
+                write_unconfirmed(f,unconfirmed_qsos,new_grids,
+                    self.adifile,args.separator)
+        return 'text/plain', f.getvalue()
+
+    def status(self):
+        import json
+        return json.dumps({'created_by': 'lotw_tool.py v' + version,
+            'adifile': self.adifile, 'qsos': len(self.qsos),
+            'loads': self.loads, 'loaded': self.loaded,
+            'requests': self.requests, 'answers_kept': len(self.answers),
+            'qrz_calls': len(self.qrz)}, indent=1)
+
+# serve -- load args.adifile and answer requests until interrupted.
+# ready, if given, is called with the server once it's listening.
+def serve(args, ready=None):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit
+
+    served = ServedLog(args, args.adifile)
+    with served.lock:
+        try:
+            served.refresh()
+        except QRZLookupError as e:
+            exit(str(e))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            try:
+                ctype, body = served.answer(url.path, url.query)
+                code = 200
+            except KeyError:
+                ctype, body, code = 'text/plain', "No such report; try " + \
+                    ', '.join(serve_reports + ('/status',)) + '\n', 404
+            except ValueError as e:
+                ctype, body, code = 'text/plain', str(e) + '\n', 400
+            except QRZLookupError as e:
+                # QRZ.com wouldn't answer while reading the log again
+                ctype, body, code = 'text/plain', str(e) + '\n', 502
+            body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', ctype + '; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', args.serve), Handler)
+    print("Serving", args.adifile, "at http://127.0.0.1:{}/".format(
+        httpd.server_address[1]))
+    if ready:
+        ready(httpd)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        httpd.server_close()
+    return served
 
-# get options
-args = getargs()
-sep = args.separator
-
-print()
-print("lotw_tool.py by N8UR, version",version)
-
-# if no input file specified, do LoTW download
-adifile = args.adifile
-if not adifile:
-    file_time = time.strftime("%Y%m%d-%H%M%S")
-    adifile = args.logcall + file_time + ".adi"
-    get_adifile(args,adifile)
-
-# now generate the logfile from the adifile
-p = Path(adifile)
-if not args.logfile:
-    logfile = str(p.parent.joinpath(p.stem + ".log"))
-else:
-    logfile = args.outfile
-make_logfile(args,adifile,logfile)
-
-if args.match_missing_grids:
-    # this file will hold the grid/call results from the qrz queries
-    qrzfile = str(p.parent.joinpath(p.stem + '_qrz_matches.txt'))
-    get_qrz_grids(args,logfile,qrzfile)
+###############################################################################
+###############################################################################
+# PROGRAM BEGINS
+###############################################################################
+###############################################################################
 
-    # read in the logfile and build list of QSOs
-    qso_list = []
-    with open(logfile,'r') as f:
-        for l in f:
-            if l.startswith('#'):
-                continue
-            l = l.strip()
-            fields = l.split(sep)
-            qso_list.append(fields)
-    
-    get_confirmed_grids(args,logfile)
-    
-    # read in confirmed grid list
-    p = Path(logfile)
-    confirmed_grids_file = str(p.parent.joinpath(p.stem +
-        "_confirmed_grids.txt"))
-    confirmed_grids_list = []
-    with open(confirmed_grids_file,'r') as f:
-        for l in f:
-            if l.startswith('#'):
-                continue
-            confirmed_grids_list.append(l.strip())
+###############################################################################
+# main -- command line entry point.  argv defaults to sys.argv; returns
+# what process_log returns (with --batch, what run_batch returns; with
+# --serve, the ServedLog once it stops).  run does the work once the
+# options are parsed.
+###############################################################################
+def main(argv=None):
+    global log_stdout
+
+    # get options
+    args = getargs(argv)
+
+    # with the log going to stdout, the progress messages go to stderr
+    if args.logfile == '-':
+        import contextlib
+        log_stdout = sys.stdout
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                return run(args, argv)
+        finally:
+            log_stdout = None
+    return run(args, argv)
+
+def run(args, argv=None):
+    global metrics
 
-    # read in qrz_grids from qrzfile
-    qrz_grids = []
-    with open(qrzfile,'r') as f:
-        for l in f:
-            if l.startswith('#'):
-                continue
-            l = l.strip()
-            fields = l.split(sep)
-            qrz_grids.append(fields)
+    print()
+    print("lotw_tool.py by N8UR, version",version)
 
-    get_gridless(logfile,qso_list,qrz_grids)
+    metrics = Metrics(args.profile)
+    try:
+        if args.batch:
+            results = run_batch(args, argv)
+        elif args.serve is not None:
+            results = serve(args)
+        else:
+            results = run_account(args)
+    finally:
+        # even a failed run's metrics show where it got to
+        if args.metrics_json:
+            metrics.write(args.metrics_json)
+    if args.match_missing_grids:
+        print()
+        print("All finished!")
+    return results
 
-    get_unconfirmed_grids(logfile,qso_list,confirmed_grids_list,qrz_grids)
+###############################################################################
+# run_account -- download (or sync) the ADI file for one account and
+# process it.  Returns what process_log returns, plus 'adifile'.
+###############################################################################
+def run_account(args):
+    # if no input file specified, do LoTW download
+    adifile = args.adifile
+    records = None
+    if args.sync:
+        adifile = args.sync
+        with metrics.stage('sync_adifile'):
+            sync_adifile(args,adifile)
+            metrics.wrote(adifile)
+    elif not adifile:
+        file_time = time.strftime("%Y%m%d-%H%M%S")
+        adifile = args.logcall + file_time + ".adi"
+        if args.stream:
+            # the download is counted in make_logfile.parse
+            records = stream_adifile(args,adifile)
+        else:
+            with metrics.stage('get_adifile'):
+                get_adifile(args,adifile)
+                metrics.wrote(adifile)
 
-exit()
+    # now generate the logfile and reports from the adifile
+    results = process_log(args,adifile,args.logfile,records)
+    results['adifile'] = adifile
+    return results
 
+###############################################################################
+# run_batch -- run each config file section in args.batch as its own
+# account, args.batch_workers at a time, with the command line options
+# plus the section's (just as --section would give), then write a
+# summary of them all.  Downloads mostly wait on LoTW, so they overlap
+# well in threads.  The accounts share one QRZ.com session, rate limit
+# and cache, logged in with the first section that has a QRZ.com login,
+# so a call that several members worked is looked up once.  An account
+# that fails is reported in the summary and doesn't stop the others.
+# Returns {section: summary dict}.
+###############################################################################
+batch_columns = ('section','logcall','qsos','confirmed','grids','gridless',
+    'unconfirmed','seconds','error')
+
+def run_batch(args, argv):
+    global qrz_lookups
+    from concurrent.futures import ThreadPoolExecutor
+
+    accounts = [getargs(argv, section) for section in args.batch]
+    print("Running",len(accounts),"accounts,",args.batch_workers,"at a time")
+
+    def run_one(account):
+        summary = {'section': account.section, 'logcall': account.logcall}
+        start = time.time()
+        try:
+            results = run_account(account)
+        except SystemExit as e:
+            summary['error'] = str(e.code)
+        except Exception as e:
+            summary['error'] = repr(e)
+        else:
+            qso_list = results['qsos']
+            summary['adifile'] = results['adifile']
+            summary['logfile'] = results['logfile']
+            summary['qsos'] = len(qso_list)
+            confirmed = [q.GRIDSQUARE[:4] for q in qso_list
+                if q.QSL_RCVD == 'Y']
+            summary['confirmed'] = len(confirmed)
+            summary['grids'] = len(set(confirmed) - {'----'})
+            for k in ('gridless','unconfirmed'):
+                if k in results:
+                    summary[k] = len(results[k])
+        summary['seconds'] = round(time.time() - start, 1)
+        print("Finished", account.section, "in", summary['seconds'],
+            "seconds" + (": " + summary['error'] if 'error' in summary
+            else ""))
+        return summary
+
+    with_qrz = [a for a in accounts if a.match_missing_grids]
+    if with_qrz:
+        qrz_lookups = QRZLookups(next((a for a in with_qrz if a.qrz_login),
+            with_qrz[0]))
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(args.batch_workers) as pool:
+            summaries = list(pool.map(run_one, accounts))
+    finally:
+        if qrz_lookups:
+            qrz_lookups.close()
+            qrz_lookups = None
+
+    summary_file = "batch" + time.strftime("%Y%m%d-%H%M%S") + \
+        "_summary.txt"
+    with open(summary_file,'w') as f:
+        f.write("# Batch of " + str(len(summaries)) + " accounts run by "\
+            "lotw_tool.py v" + version + " in {:.1f} seconds\n".format(
+            time.time() - start))
+        f.write("# " + ', '.join(batch_columns) + "\n")
+        for summary in summaries:
+            f.write('\t'.join(str(summary.get(k, '')) for k in
+                batch_columns) + '\n')
+    failed = [s['section'] for s in summaries if 'error' in s]
+    print("Wrote summary of",len(summaries),"accounts to",summary_file)
+    if failed:
+        print("FAILED:", ', '.join(failed))
+    return {s['section']: s for s in summaries}
+
+if __name__ == '__main__':
+    main()